@@ -0,0 +1,73 @@
+"""
+Compares the throughput of the SQLite performance profiles.
+
+Each profile gets a new database file. Measured are single row inserts with a commit each (typical for
+requests of a web application), inserts in one transaction and primary key reads.
+
+Usage::
+
+    python benchmarks/sqlite_profiles.py [commits] [rows]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from sqlalchemy import Column, Integer, String
+
+from groundwork_database.patterns.gw_sql_pattern import Database
+from groundwork_database.patterns.gw_sql_sqlite import SQLITE_PROFILES
+
+
+def run(profile, path, commits, rows):
+    database = Database("benchmark", "sqlite:///%s" % path, "benchmark database", sqlite_profile=profile)
+
+    class Entry(database.Base):
+        __tablename__ = "entries"
+        id = Column(Integer, primary_key=True)
+        value = Column(String)
+
+    database.create_all()
+    results = {}
+
+    start = time.time()
+    for index in range(commits):
+        database.add(Entry(value="value %s" % index))
+        database.commit()
+    results["commits/s"] = commits / (time.time() - start)
+
+    start = time.time()
+    for index in range(rows):
+        database.add(Entry(value="value %s" % index))
+    database.commit()
+    results["inserts/s"] = rows / (time.time() - start)
+
+    database.close()
+    start = time.time()
+    with database.engine.connect() as connection:
+        for index in range(1, rows + 1):
+            connection.exec_driver_sql("SELECT value FROM entries WHERE id = ?", (index,)).scalar()
+    results["reads/s"] = rows / (time.time() - start)
+
+    database.dispose()
+    return results
+
+
+def main():
+    commits = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rows = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    directory = tempfile.mkdtemp()
+    try:
+        print("%-12s %12s %12s %12s" % ("profile", "commits/s", "inserts/s", "reads/s"))
+        for profile in [None] + sorted(SQLITE_PROFILES.keys()):
+            path = os.path.join(directory, "%s.db" % profile)
+            results = run(profile, path, commits, rows)
+            print("%-12s %12.0f %12.0f %12.0f"
+                  % (profile or "default", results["commits/s"], results["inserts/s"], results["reads/s"]))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+import asyncio
+import functools
+import logging
+import time
+
+from sqlalchemy import Table, select
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_scoped_session, create_async_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+from groundwork_database.patterns.gw_sql_instrumentation import get_query_statistics
+from groundwork_database.patterns.gw_sql_pattern import DatabaseClass
+from groundwork_database.patterns.gw_sql_pool import PoolStatistics, get_engine_options
+from groundwork_database.patterns.gw_sql_schema import create_schema
+from groundwork_database.patterns.gw_sql_sqlite import apply_sqlite_pragmas, get_sqlite_pragmas, is_sqlite
+from groundwork_database.patterns.gw_sql_utils import expunge_chunk, get_database_size
+
+
+class AsyncDatabase:
+    """
+    A sql database with an asyncio engine, registered by a plugin or the application.
+    Needs an async driver, e.g. ``sqlite+aiosqlite:///my.db`` or ``postgresql+asyncpg://...``.
+
+    Sessions are scoped per asyncio task. The session of a task gets closed, when the task is done.
+    Sessions, whose close did not complete (e.g. because the loop stopped before), get closed by :func:`dispose_async`.
+
+    :param name: name of the database
+    :param url: SQLAlchemy database url with async driver
+    :param description: description of the database
+    :param plugin: plugin, which has registered the database
+    :param app: application, if the database was not registered by a plugin
+    :param pool_class: Pool class or name of a pool class from ``sqlalchemy.pool``, e.g. "AsyncAdaptedQueuePool"
+    :param pool_size: Number of connections to keep open inside the pool
+    :param max_overflow: Number of connections, which can be opened additionally to pool_size
+    :param pool_timeout: Seconds to wait for a free connection, before an error gets raised
+    :param pool_recycle: Seconds after which a connection gets recycled
+    :param pool_pre_ping: If True, connections get tested for liveness on checkout
+    :param instrument: If True, execution statistics get collected per statement, see :func:`query_stats`.
+    :param slow_query_threshold: Seconds, after which a statement gets stored in the slow query log.
+                                 Enables instrumentation.
+    :param sqlite_profile: Name of a SQLite performance profile or a dict of PRAGMAs, see :class:`~.Database`.
+    """
+
+    def __init__(self, name, url, description, plugin=None, app=None, pool_class=None, pool_size=None,
+                 max_overflow=None, pool_timeout=None, pool_recycle=None, pool_pre_ping=None, instrument=False,
+                 slow_query_threshold=None, sqlite_profile=None):
+        self.name = name
+        self.database_url = url
+        self.description = description
+        self.plugin = plugin
+        self.app = app
+        self.log = logging.getLogger(__name__)
+
+        self.engine_options = get_engine_options(pool_class, pool_size, max_overflow, pool_timeout, pool_recycle,
+                                                 pool_pre_ping)
+
+        self.sqlite_pragmas = get_sqlite_pragmas(sqlite_profile)
+        if self.sqlite_pragmas and not is_sqlite(url):
+            raise ValueError("SQLite profiles can only be used for SQLite databases")
+        self.sqlite_profile = sqlite_profile
+
+        start = time.time()
+        self.engine = create_async_engine(url, **self.engine_options)
+        apply_sqlite_pragmas(self.engine.sync_engine, self.sqlite_pragmas)
+        self._pool_statistics = PoolStatistics(self.engine.sync_engine)
+        self.query_statistics = None
+        if instrument or slow_query_threshold is not None:
+            self.query_statistics = get_query_statistics(self.engine.sync_engine, slow_query_threshold)
+        self._session_factory = sessionmaker(bind=self.engine, class_=AsyncSession, autoflush=False,
+                                             expire_on_commit=False)
+        self.session = async_scoped_session(self._create_session, scopefunc=asyncio.current_task)
+        # Sessions of finished tasks and the tasks, which close them. The loop keeps only weak references to tasks.
+        self._closing_sessions = {}
+        self.build_time = time.time() - start
+
+        self.Base = declarative_base()
+        self.classes = DatabaseClass(self, self.plugin, self.app)
+
+    def _create_session(self):
+        session = self._session_factory()
+        task = asyncio.current_task()
+        if task is not None:
+            task.add_done_callback(functools.partial(self._close_task_session, session))
+        return session
+
+    def _close_task_session(self, session, task):
+        if self.session.registry.registry.pop(task, None) is session:
+            close_task = asyncio.ensure_future(session.close())
+            self._closing_sessions[session] = close_task
+            close_task.add_done_callback(functools.partial(self._closed_task_session, session))
+
+    def _closed_task_session(self, session, close_task):
+        # Cancelled closes, e.g. on shutdown of the loop, stay registered for dispose_async()
+        if not close_task.cancelled() and close_task.exception() is None:
+            self._closing_sessions.pop(session, None)
+
+    @staticmethod
+    def _is_model(statement_or_model):
+        return hasattr(getattr(statement_or_model, "clazz", statement_or_model), "__table__")
+
+    def _get_statement(self, statement_or_model):
+        if isinstance(statement_or_model, Table):
+            return select(statement_or_model)
+        if self._is_model(statement_or_model):
+            return select(getattr(statement_or_model, "clazz", statement_or_model))
+        return statement_or_model
+
+    async def create_all(self, force=False):
+        """
+        Creates missing tables and indexes of all classes, see :func:`~.create_schema`.
+
+        :param force: If True, the database gets checked for missing tables and indexes in any case
+        :return: dict with fingerprint, skipped, created_tables and created_indexes
+        """
+        async with self.engine.begin() as connection:
+            return await connection.run_sync(create_schema, self.Base.metadata, self.name, force)
+
+    async def query(self, statement_or_model):
+        """
+        Executes a select statement inside the session of the current task.
+        A mapped class, :class:`~.DatabaseModel` or table selects all its rows::
+
+            users = (await db.query(select(User).filter_by(name="me"))).scalars().all()
+
+        :param statement_or_model: select statement, sqlalchemy table, mapped class or :class:`~.DatabaseModel`
+        :return: sqlalchemy result
+        """
+        return await self.session.execute(self._get_statement(statement_or_model))
+
+    async def execute(self, *args, **kwargs):
+        return await self.session.execute(*args, **kwargs)
+
+    def add(self, *args, **kwargs):
+        # Adding objects does not need any I/O, so there is nothing to await.
+        return self.session.add(*args, **kwargs)
+
+    async def delete(self, *args, **kwargs):
+        return await self.session.delete(*args, **kwargs)
+
+    async def commit(self, *args, **kwargs):
+        return await self.session.commit(*args, **kwargs)
+
+    async def rollback(self, *args, **kwargs):
+        return await self.session.rollback(*args, **kwargs)
+
+    async def close(self, *args, **kwargs):
+        return await self.session.close(*args, **kwargs)
+
+    async def stream(self, statement_or_model, chunk_size=1000):
+        """
+        Yields the results of a select statement in lists of up to chunk_size rows or objects.
+        Objects of a chunk get expunged from the session, as soon as the next chunk is requested::
+
+            async for users in db.stream(User, chunk_size=500):
+                ...
+
+        :param statement_or_model: select statement, sqlalchemy table, mapped class or :class:`~.DatabaseModel`
+        :param chunk_size: Number of rows or objects per chunk
+        :return: async generator of lists
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+
+        statement = self._get_statement(statement_or_model).execution_options(yield_per=chunk_size)
+        session = self.session()
+        result = await session.stream(statement)
+        if not isinstance(statement_or_model, Table) and self._is_model(statement_or_model):
+            result = result.scalars()
+        try:
+            async for chunk in result.partitions(chunk_size):
+                yield chunk
+                expunge_chunk(session, chunk)
+        finally:
+            await result.close()
+
+    def pool_stats(self):
+        """
+        Returns live statistics of the connection pool. See :func:`Database.pool_stats`.
+        """
+        return self._pool_statistics.to_dict()
+
+    def query_stats(self, order_by="total_time", limit=None):
+        """
+        Returns execution statistics per normalized statement. See :func:`Database.query_stats`.
+        """
+        if self.query_statistics is None:
+            return []
+        return self.query_statistics.statements(order_by, limit)
+
+    def get_query_statistics(self):
+        """
+        Returns the :class:`~.QueryStatistics` of the engine. Empty, if instrumentation is not enabled.
+        """
+        if self.query_statistics is None:
+            return []
+        return [self.query_statistics]
+
+    def slow_queries(self):
+        """
+        Returns the slow query log, oldest first. See :func:`Database.slow_queries`.
+        """
+        if self.query_statistics is None:
+            return []
+        return self.query_statistics.slow_queries()
+
+    def stats(self, slowest=5):
+        """
+        Returns an overview of the database usage. See :func:`Database.stats`.
+        Tables are not inspected, because this would need to await the database.
+        """
+        return {
+            "name": self.name,
+            "description": self.description,
+            "url": make_url(self.database_url).render_as_string(hide_password=True),
+            "built": True,
+            "build_time": self.build_time,
+            "classes": len(self.classes.get()),
+            "pool": self.pool_stats(),
+            "statements": self.query_statistics.summary() if self.query_statistics is not None else None,
+            "slowest_statements": self.query_stats(order_by="max_time", limit=slowest),
+            "tables": {},
+            "size": get_database_size(self.database_url),
+        }
+
+    async def dispose_async(self):
+        """
+        Closes the sessions of all tasks and disposes the engine.
+
+        :return: dict, which reports the released resources. See :func:`Database.dispose`.
+        """
+        statistics = self._pool_statistics
+        closes = statistics.closes
+
+        sessions = list(self.session.registry.registry.values())
+        self.session.registry.registry.clear()
+        for session, close_task in list(self._closing_sessions.items()):
+            if not close_task.done() and close_task.get_loop() is asyncio.get_running_loop():
+                # Waits for closes still running on this loop, instead of closing the sessions twice
+                await asyncio.wait([close_task])
+            if session in self._closing_sessions.keys():
+                sessions.append(session)
+        self._closing_sessions.clear()
+        for session in sessions:
+            await session.close()
+        await self.engine.dispose()
+
+        report = {
+            "database": self.name,
+            "sessions_closed": len(sessions),
+            "connections_closed": statistics.closes - closes,
+            "connections_open": statistics.to_dict()["checked_out"],
+            "engine_disposed": True,
+        }
+        self.log.debug("Database %s disposed: %s" % (self.name, report))
+        return report
+
+    def dispose(self):
+        """
+        Synchronous variant of :func:`dispose_async`, used by unregister and plugin deactivation.
+
+        If an event loop is running in the current thread, the teardown gets scheduled as task on it.
+        The returned report then contains database, ``scheduled: True`` and the task, whose result is the complete
+        report. Use ``await unregister_async()`` inside coroutines to wait for the teardown directly.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        if loop is None:
+            return asyncio.run(self.dispose_async())
+
+        # The loop keeps only a weak reference to its tasks, so the task must be referenced until it is done
+        self._dispose_task = loop.create_task(self.dispose_async())
+        return {
+            "database": self.name,
+            "scheduled": True,
+            "task": self._dispose_task,
+        }
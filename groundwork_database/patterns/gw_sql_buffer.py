@@ -0,0 +1,215 @@
+import collections
+import logging
+import threading
+import time
+
+from groundwork_database.patterns.gw_sql_pool import is_thread_bound
+from groundwork_database.patterns.gw_sql_utils import get_table
+
+log = logging.getLogger(__name__)
+
+
+class WriteBuffer:
+    """
+    Write-behind buffer, which collects objects and rows in memory and writes them in bulk.
+
+    A background thread flushes the buffer, if it contains max_size entries or if flush_interval seconds
+    have passed. Each flush is one transaction, executed by :func:`Database.write`, so it passes the
+    writer thread of a database with ``serialize_writes=True``.
+
+    If max_pending entries are buffered or being flushed, adding blocks until a flush has made room
+    (backpressure). With a timeout, :class:`~.WriteBufferFullException` gets raised instead.
+
+    Entries of a failed background flush get logged and dropped, see ``failed`` of :func:`to_dict`.
+
+    Connections of in-memory SQLite databases and engines with a SingletonThreadPool or StaticPool are bound to
+    threads, so a background thread would write into its own, empty database. For them, the adding thread
+    flushes the buffer itself, as soon as it contains max_size or max_pending entries. flush_interval is
+    not used then.
+    A buffered entry is lost, if the process ends before it gets flushed. :func:`Database.dispose`
+    and therefore the deactivation of the registering plugin flush the buffer.
+
+    :param database: :class:`~.Database`, which gets the entries
+    :param max_size: Number of entries, which trigger a flush
+    :param flush_interval: Maximum seconds an entry stays in the buffer
+    :param max_pending: Maximum number of buffered entries plus entries of a running flush
+    """
+
+    def __init__(self, database, max_size=1000, flush_interval=1.0, max_pending=10000):
+        self.database = database
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._items = []
+        self._in_flight = 0
+        self._thread = None
+        self._stopping = False
+
+        self.added = 0
+        self.flushes = 0
+        self.flushed = 0
+        self.failed = 0
+        self.blocked = 0
+        self.flush_time = 0.0
+
+    def add(self, obj, timeout=None):
+        """
+        Buffers a mapped object.
+
+        :param obj: object of a mapped class
+        :param timeout: Seconds to wait, if the buffer is full. None waits until there is room.
+        """
+        self._put([(None, obj)], timeout)
+
+    def insert(self, model, rows, timeout=None):
+        """
+        Buffers rows of a table.
+
+        :param model: sqlalchemy table, mapped class or :class:`~.DatabaseModel`
+        :param rows: dict or tuple or a list of them. Tuples must contain a value for each column in column order.
+        :param timeout: Seconds to wait, if the buffer is full. None waits until there is room.
+        """
+        table = get_table(model)
+        if isinstance(rows, (dict, tuple)):
+            rows = [rows]
+        columns = [column.key for column in table.columns]
+        self._put([(table, row if hasattr(row, "keys") else dict(zip(columns, row))) for row in rows], timeout)
+
+    def _put(self, items, timeout):
+        if is_thread_bound(self.database.database_url, self.database.engine_options.get("poolclass")):
+            with self._condition:
+                self._items.extend(items)
+                self.added += len(items)
+                full = len(self._items) >= min(self.max_size, self.max_pending)
+            if full:
+                self.flush()
+            return
+
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._condition:
+            self._start()
+            blocked = False
+            # An empty buffer accepts everything, so that entries larger than max_pending do not block forever
+            while self._items or self._in_flight:
+                if len(self._items) + self._in_flight + len(items) <= self.max_pending:
+                    break
+                if not blocked:
+                    blocked = True
+                    self.blocked += 1
+                    self._condition.notify_all()
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise WriteBufferFullException("Write buffer of database %s is full" % self.database.name)
+                self._condition.wait(remaining)
+            self._items.extend(items)
+            self.added += len(items)
+            if len(self._items) >= self.max_size:
+                self._condition.notify_all()
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="gw-sql-write-buffer")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                deadline = time.time() + self.flush_interval
+                while not self._stopping and len(self._items) < self.max_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                if self._stopping:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Write buffer of database %s could not be flushed" % self.database.name)
+
+    def flush(self):
+        """
+        Writes all buffered entries inside one transaction and waits until they are committed.
+        Raises the error of the database, if the write fails. The entries are dropped in this case.
+
+        :return: number of written entries
+        """
+        with self._flush_lock:
+            with self._condition:
+                items = self._items
+                self._items = []
+                self._in_flight = len(items)
+            if not items:
+                return 0
+
+            start = time.time()
+            try:
+                self.database.write(_write_items, items)
+            except Exception:
+                with self._condition:
+                    self.failed += len(items)
+                raise
+            finally:
+                with self._condition:
+                    self._in_flight = 0
+                    self._condition.notify_all()
+
+            duration = time.time() - start
+            with self._condition:
+                self.flushes += 1
+                self.flushed += len(items)
+                self.flush_time += duration
+            log.debug("Write buffer of database %s flushed %s entries in %.4fs"
+                      % (self.database.name, len(items), duration))
+            return len(items)
+
+    def stop(self):
+        """
+        Stops the background thread and flushes the remaining entries.
+
+        :return: number of written entries
+        """
+        with self._condition:
+            thread = self._thread
+            self._thread = None
+            self._stopping = True
+            self._condition.notify_all()
+        if thread is not None:
+            thread.join()
+        return self.flush()
+
+    def to_dict(self):
+        with self._condition:
+            return {
+                "buffered": len(self._items),
+                "in_flight": self._in_flight,
+                "added": self.added,
+                "flushes": self.flushes,
+                "flushed": self.flushed,
+                "failed": self.failed,
+                "blocked": self.blocked,
+                "avg_flush_size": float(self.flushed) / self.flushes if self.flushes else 0.0,
+                "flush_time": self.flush_time,
+            }
+
+
+def _write_items(session, items):
+    rows = collections.OrderedDict()
+    for table, item in items:
+        if table is None:
+            session.add(item)
+        else:
+            # executemany needs the same columns for all rows of a statement
+            rows.setdefault((table, tuple(sorted(item.keys()))), []).append(item)
+    session.flush()
+    for (table, _), table_rows in rows.items():
+        session.execute(table.insert(), table_rows)
+
+
+class WriteBufferFullException(Exception):
+    pass
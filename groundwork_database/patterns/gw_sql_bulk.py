@@ -0,0 +1,178 @@
+import itertools
+import logging
+import time
+
+from sqlalchemy import and_, bindparam, select, tuple_
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+log = logging.getLogger(__name__)
+
+UPSERT_ON_CONFLICT = "on_conflict"
+UPSERT_ON_DUPLICATE_KEY = "on_duplicate_key"
+UPSERT_UPDATE_INSERT = "update_insert"
+
+
+def bulk_insert(engine, table, rows, batch_size=1000):
+    """
+    Inserts rows in batches.
+
+    :param engine: sqlalchemy engine
+    :param table: sqlalchemy table
+    :param rows: iterable of dicts or tuples. Tuples must contain a value for each column in column order.
+    :param batch_size: Number of rows per executemany call and transaction
+    :return: dict with rows, batches, time and batch_times
+    """
+    statement = table.insert()
+
+    def execute(connection, batch):
+        connection.execute(statement, batch)
+
+    return _execute_batches(engine, table, rows, batch_size, execute)
+
+
+def bulk_upsert(engine, table, rows, batch_size=1000, index_elements=None, method=None):
+    """
+    Inserts rows in batches and updates already existing rows.
+
+    The dialect-native ``INSERT .. ON CONFLICT`` (PostgreSQL, SQLite >= 3.24) or
+    ``INSERT .. ON DUPLICATE KEY UPDATE`` (MySQL, MariaDB) is used.
+    For all other databases the existing keys of a batch get selected, existing rows get updated and
+    the others get inserted.
+
+    :param engine: sqlalchemy engine
+    :param table: sqlalchemy table
+    :param rows: iterable of dicts or tuples. Tuples must contain a value for each column in column order.
+    :param batch_size: Number of rows per executemany call and transaction
+    :param index_elements: Column names, which identify a row. Default are the primary key columns.
+    :param method: Upsert method to use. Default is the best one for the dialect of the engine.
+    :return: dict with rows, batches, time, batch_times and method
+    """
+    if index_elements is None:
+        index_elements = [column.key for column in table.primary_key.columns]
+    if not index_elements:
+        raise ValueError("Table %s has no primary key, index_elements must be given" % table.name)
+
+    if method is None:
+        method = get_upsert_method(engine)
+
+    if method == UPSERT_ON_CONFLICT:
+        insert = postgresql.insert if engine.dialect.name == "postgresql" else sqlite.insert
+        upsert = _on_conflict(insert)
+    elif method == UPSERT_ON_DUPLICATE_KEY:
+        upsert = _on_duplicate_key
+    elif method == UPSERT_UPDATE_INSERT:
+        upsert = _update_insert
+    else:
+        raise ValueError("Unknown upsert method %s" % method)
+
+    def execute(connection, batch):
+        # A row must not be affected twice by one statement, so only the last row of a key is used.
+        unique_rows = {}
+        for row in batch:
+            unique_rows[tuple(row[key] for key in index_elements)] = row
+        upsert(connection, table, list(unique_rows.values()), index_elements)
+
+    report = _execute_batches(engine, table, rows, batch_size, execute)
+    report["method"] = method
+    return report
+
+
+def get_upsert_method(engine):
+    """
+    Returns the best upsert method for the dialect of the given engine.
+    """
+    dialect = engine.dialect
+    if dialect.name == "postgresql":
+        return UPSERT_ON_CONFLICT
+    if dialect.name == "sqlite" and dialect.dbapi is not None \
+            and getattr(dialect.dbapi, "sqlite_version_info", (0,)) >= (3, 24, 0):
+        return UPSERT_ON_CONFLICT
+    if dialect.name in ("mysql", "mariadb"):
+        return UPSERT_ON_DUPLICATE_KEY
+    return UPSERT_UPDATE_INSERT
+
+
+def _on_conflict(insert):
+    def upsert(connection, table, batch, index_elements):
+        statement = insert(table)
+        update_columns = [key for key in batch[0].keys() if key not in index_elements]
+        if update_columns:
+            statement = statement.on_conflict_do_update(
+                index_elements=index_elements,
+                set_=dict((key, statement.excluded[key]) for key in update_columns))
+        else:
+            statement = statement.on_conflict_do_nothing(index_elements=index_elements)
+        connection.execute(statement, batch)
+    return upsert
+
+
+def _on_duplicate_key(connection, table, batch, index_elements):
+    statement = mysql.insert(table)
+    update_columns = [key for key in batch[0].keys() if key not in index_elements] or index_elements[:1]
+    statement = statement.on_duplicate_key_update(
+        **dict((key, statement.inserted[key]) for key in update_columns))
+    connection.execute(statement, batch)
+
+
+def _update_insert(connection, table, batch, index_elements):
+    key_columns = [table.c[key] for key in index_elements]
+    keys = [tuple(row[key] for key in index_elements) for row in batch]
+    if len(key_columns) == 1:
+        condition = key_columns[0].in_([key[0] for key in keys])
+    else:
+        condition = tuple_(*key_columns).in_(keys)
+    existing = set(tuple(row) for row in connection.execute(select(*key_columns).where(condition)))
+
+    updates = []
+    inserts = []
+    for key, row in zip(keys, batch):
+        if key in existing:
+            updates.append(row)
+        else:
+            inserts.append(row)
+
+    update_columns = [key for key in batch[0].keys() if key not in index_elements]
+    if updates and update_columns:
+        # Bind parameters must not be named like columns, which are part of the SET clause
+        statement = table.update().where(and_(*[column == bindparam("_key_%s" % column.key)
+                                                for column in key_columns]))
+        parameters = []
+        for row in updates:
+            parameter = dict((key, row[key]) for key in update_columns)
+            for key in index_elements:
+                parameter["_key_%s" % key] = row[key]
+            parameters.append(parameter)
+        connection.execute(statement, parameters)
+    if inserts:
+        connection.execute(table.insert(), inserts)
+
+
+def _execute_batches(engine, table, rows, batch_size, execute):
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1")
+
+    columns = [column.key for column in table.columns]
+    report = {"rows": 0, "batches": 0, "time": 0.0, "batch_times": []}
+    iterator = iter(rows)
+    while True:
+        batch = [_as_dict(row, columns) for row in itertools.islice(iterator, batch_size)]
+        if not batch:
+            break
+        start = time.time()
+        with engine.begin() as connection:
+            execute(connection, batch)
+        batch_time = time.time() - start
+
+        report["rows"] += len(batch)
+        report["batches"] += 1
+        report["time"] += batch_time
+        report["batch_times"].append(batch_time)
+        log.debug("Batch %s of %s rows written to %s in %.4fs"
+                  % (report["batches"], len(batch), table.name, batch_time))
+    return report
+
+
+def _as_dict(row, columns):
+    if hasattr(row, "keys"):
+        return row
+    return dict(zip(columns, row))
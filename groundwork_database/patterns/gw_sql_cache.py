@@ -0,0 +1,304 @@
+import collections
+import sys
+import threading
+import time
+from collections.abc import Sequence
+
+from sqlalchemy import Table, event
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.loading import merge_frozen_result
+from sqlalchemy.sql.ddl import DDLElement
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.elements import TextClause
+from sqlalchemy.sql.util import find_tables
+
+# Marker for statements, whose written tables are unknown (e.g. text statements). Invalidates all entries.
+ALL_TABLES = "*"
+
+
+class _CacheEntry:
+    def __init__(self, result, tables, size, expires):
+        self.result = result
+        self.tables = tables
+        self.size = size
+        self.expires = expires
+
+
+class ResultCache:
+    """
+    Caches the results of ORM selects executed by sessions of a database.
+
+    Entries are keyed on the SQLAlchemy cache key of the statement plus its parameters and bounded by number of
+    entries and estimated memory (least recently used entries get evicted first) and by a time to live.
+    Entries get invalidated, when a commit has written to any table the cached select has read, including the
+    tables of eager loaded relationships.
+
+    Selects of a session, which has flushed changes inside the current transaction, bypass the cache.
+    So do selects with FOR UPDATE and statements without a cache key.
+    A single select bypasses the cache by ``query.execution_options(result_cache=False)``.
+
+    Writes are detected by insert, update and delete statements. Other writing statements (e.g. ``text()``)
+    invalidate the complete cache.
+
+    :param max_entries: Maximum number of cached results
+    :param max_bytes: Maximum estimated memory of all cached results
+    :param ttl: Seconds after which a cached result expires
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024, ttl=300):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._keys_by_table = collections.defaultdict(set)
+        self._generation = 0
+        self._bytes = 0
+        self._written_key = "result_cache_written_%s" % id(self)
+        self._flushed_key = "result_cache_flushed_%s" % id(self)
+        self._dialect = None
+        # Tables read by the select, which currently gets loaded by this thread
+        self._loading = threading.local()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def attach(self, engine, session_factory):
+        """
+        Registers the needed event listeners on the engine and sessions.
+
+        :param engine: engine, whose commits invalidate the cache
+        :param session_factory: sessionmaker, whose selects get cached
+        """
+        self._dialect = engine.dialect
+        event.listen(engine, "after_execute", self._after_execute)
+        event.listen(engine, "commit", self._on_commit)
+        event.listen(engine, "rollback", self._on_rollback)
+        event.listen(session_factory, "do_orm_execute", self._do_orm_execute)
+        event.listen(session_factory, "after_flush", self._after_flush)
+        event.listen(session_factory, "after_commit", self._after_transaction)
+        event.listen(session_factory, "after_rollback", self._after_transaction)
+
+    def detach(self, engine, session_factory):
+        """
+        Removes the event listeners, e.g. if the engine is shared and stays alive.
+        """
+        event.remove(engine, "after_execute", self._after_execute)
+        event.remove(engine, "commit", self._on_commit)
+        event.remove(engine, "rollback", self._on_rollback)
+        event.remove(session_factory, "do_orm_execute", self._do_orm_execute)
+        event.remove(session_factory, "after_flush", self._after_flush)
+        event.remove(session_factory, "after_commit", self._after_transaction)
+        event.remove(session_factory, "after_rollback", self._after_transaction)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.expires < time.time():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.result
+
+    def set(self, key, result, tables, generation=None):
+        """
+        Stores a result.
+
+        :param key: cache key
+        :param result: FrozenResult
+        :param tables: names of the tables the result was read from
+        :param generation: value of :func:`generation` before the result was read.
+                           If the cache got invalidated since then, the result is not stored.
+        """
+        size = _estimate_size(result)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _CacheEntry(result, tables, size, time.time() + self.ttl)
+            self._bytes += size
+            for table in tables:
+                self._keys_by_table[table].add(key)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def generation(self):
+        return self._generation
+
+    def invalidate(self, tables):
+        """
+        Removes all entries, which have read from one of the given tables.
+
+        :param tables: table names. :data:`ALL_TABLES` removes all entries.
+        :return: number of removed entries
+        """
+        with self._lock:
+            self._generation += 1
+            if ALL_TABLES in tables:
+                keys = list(self._entries.keys())
+            else:
+                keys = set()
+                for table in tables:
+                    keys.update(self._keys_by_table.get(table, ()))
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._keys_by_table.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+        for table in entry.tables:
+            keys = self._keys_by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_table[table]
+
+    def to_dict(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": float(self.hits) / requests if requests else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+    def _do_orm_execute(self, orm_execute_state):
+        if not orm_execute_state.is_select or orm_execute_state.is_column_load:
+            return None
+        statement = orm_execute_state.statement
+        if orm_execute_state.is_relationship_load:
+            # Selects of eager loaders (e.g. selectinload) are part of the cached result
+            tables = getattr(self._loading, "tables", None)
+            if tables is not None:
+                tables.update(_get_read_tables(statement, self._dialect))
+            return None
+        options = orm_execute_state.execution_options
+        if not options.get("result_cache", True) or options.get("yield_per") or options.get("stream_results"):
+            return None
+        if getattr(statement, "_for_update_arg", None) is not None:
+            return None
+        session = orm_execute_state.session
+        if session.info.get(self._flushed_key):
+            return None
+
+        cache_key = statement._generate_cache_key()
+        if cache_key is None:
+            return None
+        # Bound values are not part of the cache key itself. Anonymous parameter names change with each statement
+        # object, so the values get used in order.
+        key = (cache_key.key, repr([parameter.effective_value for parameter in cache_key.bindparams]),
+               repr(sorted((orm_execute_state.parameters or {}).items())))
+
+        cached = self.get(key)
+        if cached is None:
+            generation = self.generation()
+            previous = getattr(self._loading, "tables", None)
+            tables = self._loading.tables = _get_read_tables(statement, self._dialect)
+            try:
+                result = orm_execute_state.invoke_statement().freeze()
+            finally:
+                self._loading.tables = previous
+            # The cache stores detached copies of loaded objects, so that changes of the caller
+            # do not modify cached objects.
+            scratch_session = Session()
+            cached = merge_frozen_result(scratch_session, statement, result, load=False)
+            scratch_session.close()
+            self.set(key, cached, tables, generation)
+            return result()
+        return merge_frozen_result(session, statement, cached, load=False)()
+
+    def _after_flush(self, session, flush_context):
+        session.info[self._flushed_key] = True
+
+    def _after_transaction(self, session):
+        session.info.pop(self._flushed_key, None)
+
+    def _after_execute(self, conn, clauseelement, *args):
+        table = _get_written_table(clauseelement)
+        if table is not None:
+            conn.info.setdefault(self._written_key, set()).add(table)
+
+    def _on_commit(self, conn):
+        tables = conn.info.pop(self._written_key, None)
+        if tables:
+            self.invalidate(tables)
+
+    def _on_rollback(self, conn):
+        conn.info.pop(self._written_key, None)
+
+
+def _get_read_tables(statement, dialect):
+    """
+    Returns the names of the tables a select reads from. ORM selects get compiled, so that joins added by
+    eager loaders (e.g. joinedload) are part of it.
+    """
+    compile_state = getattr(statement.compile(dialect=dialect), "compile_state", None)
+    statement = getattr(compile_state, "statement", statement)
+    return set(table.fullname for table in find_tables(statement) if isinstance(table, Table))
+
+
+def _get_written_table(clauseelement):
+    """
+    Returns the name of the table a statement writes to, :data:`ALL_TABLES` if it is unknown or
+    None for reading statements.
+    """
+    if isinstance(clauseelement, UpdateBase):
+        table = getattr(clauseelement, "table", None)
+        return table.fullname if isinstance(table, Table) else ALL_TABLES
+    if isinstance(clauseelement, DDLElement):
+        table = getattr(clauseelement, "element", None)
+        return table.fullname if isinstance(table, Table) else ALL_TABLES
+    if isinstance(clauseelement, TextClause):
+        statement = clauseelement.text
+    elif isinstance(clauseelement, str):
+        statement = clauseelement
+    else:
+        return None
+    if statement.lstrip().upper().startswith(("SELECT", "PRAGMA", "EXPLAIN")):
+        return None
+    return ALL_TABLES
+
+
+def _estimate_size(result):
+    """
+    Returns a rough estimation of the memory needed by the rows of a FrozenResult.
+    """
+    size = sys.getsizeof(result.data)
+    for row in result.data:
+        size += sys.getsizeof(row)
+        # Rows of single entity results are the objects itself
+        for value in (row if isinstance(row, Sequence) else (row,)):
+            state = getattr(value, "__dict__", None)
+            if state is not None:
+                size += sum(sys.getsizeof(attribute) for attribute in state.values())
+            else:
+                size += sys.getsizeof(value)
+    return size
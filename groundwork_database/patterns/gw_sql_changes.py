@@ -0,0 +1,260 @@
+import collections
+import logging
+import threading
+import time
+
+from sqlalchemy import event, inspect
+
+log = logging.getLogger(__name__)
+
+INSERTED = "inserted"
+UPDATED = "updated"
+DELETED = "deleted"
+
+
+class ChangeFeed:
+    """
+    Publishes the primary keys of inserted, updated and deleted objects of registered classes after each
+    successful commit, so that caches and search indexes can be updated incrementally instead of polling.
+
+    Changes get collected per transaction by the flushes of a session. Changes of rolled back transactions and
+    savepoints get dropped. Each commit publishes one change set, a dict with database, time and changes::
+
+        {"database": "my_db", "time": 1500000000.0,
+         "changes": {"User": {"inserted": [3], "updated": [1], "deleted": [2]}}}
+
+    Primary keys are single values or tuples for composite primary keys. An object inserted and deleted
+    inside the same transaction is not part of the change set. Writes, which bypass the session
+    (bulk inserts, upserts and the write buffer), are not part of the feed.
+
+    Change sets get passed to the publish function (synchronously, inside the committing thread) and to the queue of
+    each subscription (see :func:`subscribe`).
+
+    :param get_models: Function, which returns a dict of mapped class and name of the registered classes
+    :param publish: Function, which gets each change set. Exceptions get logged and do not affect the commit.
+    :param database: name of the database
+    """
+
+    def __init__(self, get_models, publish=None, database=None):
+        self.get_models = get_models
+        self.publish = publish
+        self.database = database
+        self._lock = threading.Lock()
+        self._subscriptions = []
+        self._pending_key = "change_feed_pending_%s" % id(self)
+        self.change_sets = 0
+
+    def attach(self, session_factory):
+        event.listen(session_factory, "after_flush", self._after_flush)
+        event.listen(session_factory, "after_commit", self._after_commit)
+        event.listen(session_factory, "after_soft_rollback", self._after_soft_rollback)
+        event.listen(session_factory, "after_transaction_end", self._after_transaction_end)
+
+    def subscribe(self, max_size=1000):
+        """
+        Returns a new :class:`~.ChangeSubscription`, which receives all following change sets.
+        """
+        subscription = ChangeSubscription(self, max_size)
+        with self._lock:
+            self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Stops a subscription. Queued change sets can still be read, waiting consumers get None.
+        """
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+        subscription._close()
+
+    def close(self):
+        """
+        Closes all subscriptions. Waiting consumers get None.
+        """
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+            self._subscriptions = []
+        for subscription in subscriptions:
+            subscription.close()
+
+    def to_dict(self):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        return {
+            "change_sets": self.change_sets,
+            "subscriptions": len(subscriptions),
+            "dropped": sum(subscription.dropped for subscription in subscriptions),
+        }
+
+    def _get_pending(self, session):
+        # List of (transaction, name, kind, primary key) in order of the flushes
+        return session.info.setdefault(self._pending_key, [])
+
+    def _after_flush(self, session, flush_context):
+        models = self.get_models()
+        if not models:
+            return
+        # Changes get kept per savepoint, so that they can be dropped if it gets rolled back
+        transaction = session.get_nested_transaction() or session.get_transaction()
+        pending = self._get_pending(session)
+        for kind, objects in ((INSERTED, session.new), (DELETED, session.deleted), (UPDATED, session.dirty)):
+            for obj in objects:
+                name = _get_model_name(models, type(obj))
+                if name is None:
+                    continue
+                if kind == UPDATED and not session.is_modified(obj, include_collections=False):
+                    continue
+                pending.append((transaction, name, kind, _get_primary_key(obj)))
+
+    def _after_soft_rollback(self, session, previous_transaction):
+        # Drops the changes of the rolled back transaction and of all savepoints inside it
+        pending = self._get_pending(session)
+        pending[:] = [change for change in pending if not _is_inside(change[0], previous_transaction)]
+
+    def _after_transaction_end(self, session, transaction):
+        # Changes of a transaction, which ended without commit, e.g. by closing the session, get dropped
+        if transaction.parent is None:
+            session.info.pop(self._pending_key, None)
+
+    def _after_commit(self, session):
+        # Released savepoints fire after_commit as well, but their changes get published by the outer commit
+        if session.in_nested_transaction():
+            return
+        pending = session.info.pop(self._pending_key, None)
+        if not pending:
+            return
+        changes = collections.OrderedDict()
+        for transaction, name, kind, key in pending:
+            _add_change(changes, name, kind, key)
+        changes = collections.OrderedDict(
+            (name, dict((kind, list(keys.keys())) for kind, keys in kinds.items()))
+            for name, kinds in changes.items() if any(kinds.values()))
+        if not changes:
+            return
+
+        change_set = {"database": self.database, "time": time.time(), "changes": changes}
+        with self._lock:
+            self.change_sets += 1
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription._put(change_set)
+        if self.publish is not None:
+            try:
+                self.publish(change_set)
+            except Exception:
+                log.exception("Change set of database %s could not be published" % self.database)
+
+
+class ChangeSubscription:
+    """
+    Bounded queue of change sets of a :class:`~.ChangeFeed` for asynchronous consumers, e.g. a thread, which
+    updates a search index::
+
+        subscription = db.change_feed.subscribe(max_size=100)
+        for change_set in subscription:
+            update_index(change_set["changes"])
+
+    Committing never waits for consumers. If the queue is full, the oldest change set gets dropped and
+    :attr:`dropped` gets increased, so that a consumer can detect it and reload its data completely.
+
+    :param feed: :class:`~.ChangeFeed`
+    :param max_size: Maximum number of queued change sets
+    """
+
+    def __init__(self, feed, max_size=1000):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.feed = feed
+        self.max_size = max_size
+        self.dropped = 0
+        self.closed = False
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+
+    def _put(self, change_set):
+        with self._condition:
+            if len(self._queue) >= self.max_size:
+                self._queue.popleft()
+                self.dropped += 1
+            self._queue.append(change_set)
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Returns the next change set. Waits up to timeout seconds, if the queue is empty.
+
+        :return: change set or None, if the timeout has expired or the subscription is closed
+        """
+        with self._condition:
+            deadline = time.time() + timeout if timeout is not None else None
+            while not self._queue and not self.closed:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+            if self._queue:
+                return self._queue.popleft()
+            return None
+
+    def __len__(self):
+        with self._condition:
+            return len(self._queue)
+
+    def __iter__(self):
+        while True:
+            change_set = self.get()
+            if change_set is None:
+                return
+            yield change_set
+
+    def close(self):
+        """
+        Stops the subscription. Queued change sets can still be read.
+        """
+        self.feed.unsubscribe(self)
+
+    def _close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+
+def _is_inside(transaction, outer_transaction):
+    while transaction is not None:
+        if transaction is outer_transaction:
+            return True
+        transaction = transaction.parent
+    return False
+
+
+def _get_primary_key(obj):
+    state = inspect(obj)
+    key = state.identity if state.identity is not None else tuple(state.mapper.primary_key_from_instance(obj))
+    return key[0] if len(key) == 1 else tuple(key)
+
+
+def _add_change(changes, name, kind, key):
+    kinds = changes.setdefault(name, collections.OrderedDict(
+        ((INSERTED, collections.OrderedDict()), (UPDATED, collections.OrderedDict()),
+         (DELETED, collections.OrderedDict()))))
+    if kind == DELETED:
+        kinds[UPDATED].pop(key, None)
+        if kinds[INSERTED].pop(key, None) is None:
+            kinds[DELETED][key] = True
+    elif kind == UPDATED:
+        if key not in kinds[INSERTED]:
+            kinds[UPDATED][key] = True
+    elif kinds[DELETED].pop(key, None) is not None:
+        # Deleted and inserted again by the same transaction
+        kinds[UPDATED][key] = True
+    else:
+        kinds[INSERTED][key] = True
+
+
+def _get_model_name(models, clazz):
+    # Objects of subclasses belong to their registered base class
+    for base in clazz.__mro__:
+        if base in models:
+            return models[base]
+    return None
@@ -0,0 +1,212 @@
+import logging
+import re
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.expression import BinaryExpression, ColumnClause, Delete, Select, Update
+
+from groundwork_database.patterns.gw_sql_instrumentation import get_fingerprint, normalize_statement
+
+log = logging.getLogger(__name__)
+
+#: EXPLAIN prefix per dialect. Statements of other dialects do not get explained.
+EXPLAIN_PREFIXES = {
+    "sqlite": "EXPLAIN QUERY PLAN ",
+    "postgresql": "EXPLAIN ",
+    "mysql": "EXPLAIN ",
+    "mariadb": "EXPLAIN ",
+}
+
+_EXPLAINABLE = re.compile(r"^\s*(SELECT|WITH|UPDATE|DELETE)\b", re.IGNORECASE)
+_SQLITE_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$")
+_POSTGRESQL_SCAN = re.compile(r"Seq Scan on (\w+)")
+_EQUALITY_OPERATORS = (operators.eq, operators.in_op, operators.is_)
+
+
+class ExplainCapture:
+    """
+    Runs EXPLAIN for statements, which take longer than a threshold, and stores the plan per statement fingerprint.
+    Each fingerprint gets explained once, by the first execution over the threshold.
+
+    Plans get checked for full table scans on the given tables. For those, an index on the filtered and
+    sorted columns of the statement gets suggested: columns compared by equality first, followed by
+    columns compared by ranges and by the columns of ORDER BY.
+
+    The EXPLAIN runs on the connection of the slow statement, so it adds to the time of the current request and
+    sees its uncommitted changes. On PostgreSQL, it runs inside a savepoint, so that a failing EXPLAIN does not
+    abort the transaction of the statement.
+
+    :param engine: sqlalchemy engine
+    :param threshold: Seconds, after which a statement gets explained
+    :param get_tables: Function, which returns the names of the tables to check for full scans
+    :param report_size: Maximum number of stored plans
+    """
+
+    def __init__(self, engine, threshold, get_tables, report_size=100):
+        self.engine = engine
+        self.threshold = threshold
+        self.get_tables = get_tables
+        self.report_size = report_size
+        self._prefix = EXPLAIN_PREFIXES.get(engine.dialect.name)
+        self._lock = threading.Lock()
+        self._plans = {}
+        self._start_key = "explain_start_time_%s" % id(self)
+
+    def attach(self):
+        event.listen(self.engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(self.engine, "after_cursor_execute", self._after_cursor_execute)
+        event.listen(self.engine, "handle_error", self._handle_error)
+
+    def detach(self):
+        event.remove(self.engine, "before_cursor_execute", self._before_cursor_execute)
+        event.remove(self.engine, "after_cursor_execute", self._after_cursor_execute)
+        event.remove(self.engine, "handle_error", self._handle_error)
+
+    def plans(self):
+        """
+        Returns the captured plans, slowest first. Each one is a dict with fingerprint, statement, duration,
+        time, plan (list of strings), full_scans (table names) and suggested_indexes (CREATE INDEX statements).
+        """
+        with self._lock:
+            plans = [dict(plan) for plan in self._plans.values()]
+        plans.sort(key=lambda plan: plan["duration"], reverse=True)
+        return plans
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault(self._start_key, []).append((cursor, time.time()))
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        duration = time.time() - conn.info[self._start_key].pop()[1]
+        if duration < self.threshold or executemany or self._prefix is None or not _EXPLAINABLE.match(statement):
+            return
+
+        normalized_statement = normalize_statement(statement)
+        fingerprint = get_fingerprint(normalized_statement)
+        with self._lock:
+            if fingerprint in self._plans or len(self._plans) >= self.report_size:
+                return
+            # Reserve the fingerprint, so that concurrent executions do not explain it again
+            self._plans[fingerprint] = None
+
+        try:
+            plan = self._explain(conn.connection, statement, parameters)
+        except Exception as e:
+            log.warning("Statement %s could not be explained: %s" % (fingerprint, e))
+            with self._lock:
+                self._plans.pop(fingerprint, None)
+            return
+
+        tables = self.get_tables()
+        full_scans = [table for table in _get_full_scans(self.engine.dialect.name, plan) if table in tables]
+        compiled = getattr(context, "compiled", None)
+        clause = getattr(compiled, "statement", None)
+        suggested_indexes = []
+        for table in full_scans:
+            columns = _get_index_columns(clause, table)
+            if columns:
+                suggested_indexes.append("CREATE INDEX ix_%s_%s ON %s (%s)"
+                                         % (table, "_".join(columns), table, ", ".join(columns)))
+
+        with self._lock:
+            self._plans[fingerprint] = {
+                "fingerprint": fingerprint,
+                "statement": normalized_statement,
+                "duration": duration,
+                "time": time.time(),
+                "plan": plan,
+                "full_scans": full_scans,
+                "suggested_indexes": suggested_indexes,
+            }
+        if full_scans:
+            log.warning("Slow statement %s scans complete tables %s. Suggested indexes: %s"
+                        % (fingerprint, ", ".join(full_scans), "; ".join(suggested_indexes) or "none"))
+
+    def _handle_error(self, exception_context):
+        # Failed statements do not reach after_cursor_execute, so their start time gets dropped here
+        context = exception_context.execution_context
+        if exception_context.connection is None or context is None:
+            return
+        starts = exception_context.connection.info.get(self._start_key)
+        if starts and starts[-1][0] is context.cursor:
+            starts.pop()
+
+    def _explain(self, connection, statement, parameters):
+        # An error inside a transaction of PostgreSQL aborts it, until it gets rolled back
+        savepoint = self.engine.dialect.name == "postgresql" and not getattr(connection, "autocommit", False)
+        cursor = connection.cursor()
+        try:
+            if savepoint:
+                cursor.execute("SAVEPOINT gw_explain")
+            try:
+                cursor.execute(self._prefix + statement, parameters)
+                rows = cursor.fetchall()
+                names = [description[0] for description in cursor.description or []]
+            except Exception:
+                if savepoint:
+                    cursor.execute("ROLLBACK TO SAVEPOINT gw_explain")
+                raise
+            if savepoint:
+                cursor.execute("RELEASE SAVEPOINT gw_explain")
+        finally:
+            cursor.close()
+        if self.engine.dialect.name == "sqlite":
+            # Rows are id, parent, notused, detail
+            return [row[-1] for row in rows]
+        if self.engine.dialect.name == "postgresql":
+            return [row[0] for row in rows]
+        return [", ".join("%s=%s" % (name, value) for name, value in zip(names, row)) for row in rows]
+
+
+def _get_full_scans(dialect_name, plan):
+    tables = []
+    for line in plan:
+        if dialect_name == "sqlite":
+            match = _SQLITE_SCAN.match(line.strip())
+            table = match.group(1) if match else None
+        elif dialect_name == "postgresql":
+            match = _POSTGRESQL_SCAN.search(line)
+            table = match.group(1) if match else None
+        else:
+            values = dict(part.split("=", 1) for part in line.split(", ") if "=" in part)
+            table = values.get("table") if values.get("type") == "ALL" else None
+        if table is not None and table not in tables:
+            tables.append(table)
+    return tables
+
+
+def _get_index_columns(clause, table):
+    """
+    Returns the columns of the table, which are filtered or sorted by the statement.
+    """
+    if not isinstance(clause, (Select, Update, Delete)):
+        return []
+
+    equality, ranges = [], []
+    if clause.whereclause is not None:
+        for element in visitors.iterate(clause.whereclause):
+            if not isinstance(element, BinaryExpression):
+                continue
+            for side in (element.left, element.right):
+                if _is_column_of(side, table):
+                    target = equality if element.operator in _EQUALITY_OPERATORS else ranges
+                    target.append(side.name)
+
+    ordering = []
+    for element in getattr(clause, "_order_by_clauses", ()):
+        for column in visitors.iterate(element):
+            if _is_column_of(column, table):
+                ordering.append(column.name)
+
+    columns = []
+    for name in equality + ranges + ordering:
+        if name not in columns:
+            columns.append(name)
+    return columns
+
+
+def _is_column_of(element, table):
+    element_table = getattr(element, "table", None)
+    return isinstance(element, ColumnClause) and element_table is not None and \
+        getattr(element_table, "name", None) == table
@@ -0,0 +1,260 @@
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from sqlalchemy import text
+
+from groundwork_database.patterns.gw_sql_pool import is_thread_bound
+
+log = logging.getLogger(__name__)
+
+# Seconds between checks of the deadlines of running calls
+_POLL_INTERVAL = 0.05
+
+# Marks the worker threads of all fan-out pools and holds the databases of their running calls
+_local = threading.local()
+
+
+class FanOutResult:
+    """
+    Result of :func:`FanOut.run`.
+
+    Results and errors are ordered like the given databases. A database is either in results, errors or timed_out.
+    """
+
+    def __init__(self, names):
+        self.names = list(names)
+        #: OrderedDict of database name and returned value
+        self.results = collections.OrderedDict()
+        #: OrderedDict of database name and raised exception
+        self.errors = collections.OrderedDict()
+        #: List of names of databases, which did not answer inside their timeout
+        self.timed_out = []
+        #: dict of database name and seconds, which the call needed. Missing for timed out calls.
+        self.durations = {}
+
+    @property
+    def ok(self):
+        """
+        True, if all databases have returned a result.
+        """
+        return not self.errors and not self.timed_out
+
+    @property
+    def failed(self):
+        """
+        Names of databases, which have raised an exception or timed out.
+        """
+        return [name for name in self.names if name in self.errors.keys() or name in self.timed_out]
+
+    def merge(self, key=None, reverse=False, limit=None):
+        """
+        Merges the list results of all successful databases into one list.
+
+        :param key: function to sort the merged items by, e.g. ``lambda row: row.score``.
+                    Default keeps the items in order of the databases.
+        :param reverse: If True, sorts descending
+        :param limit: Maximum number of returned items
+        :return: list
+        """
+        items = []
+        for name, result in self.results.items():
+            if not isinstance(result, (list, tuple)):
+                raise ValueError("Result of database %s is no list and can not be merged" % name)
+            items.extend(result)
+        if key is not None:
+            items.sort(key=key, reverse=reverse)
+        return items[:limit] if limit is not None else items
+
+    def to_dict(self):
+        return {
+            "results": dict(self.results),
+            "errors": dict((name, str(error)) for name, error in self.errors.items()),
+            "timed_out": list(self.timed_out),
+            "durations": dict(self.durations),
+        }
+
+
+class FanOut:
+    """
+    Runs a function for several databases at the same time on a bounded thread pool, e.g. for global searches,
+    health checks or exports across the databases of all plugins. Total latency is the one of the slowest database
+    instead of the sum of all.
+
+    Each database has its own timeout, which starts when its call starts. Failures and timeouts of single
+    databases get reported by the :class:`~.FanOutResult` and do not cancel the calls of the other ones.
+    Python threads can not be interrupted, so a timed out call keeps running inside its worker until it returns
+    and its result gets dropped. Until then, the worker is not available for other calls.
+
+    Connections of in-memory SQLite databases and engines with a SingletonThreadPool or StaticPool are bound to
+    threads, so a worker would not see their tables. Their calls get executed one after another by the calling
+    thread, while the workers run the other calls. Timeouts do not apply to them.
+
+    A fan-out started by a worker, e.g. by :func:`ShardedDatabase.fetch` inside a fan-out function, runs all its
+    calls one after another on that worker. Waiting for other workers could block all of them forever.
+
+    :param max_workers: Maximum number of threads, which run calls at the same time
+    """
+
+    def __init__(self, max_workers=8):
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1")
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def run(self, databases, function, timeout=None):
+        """
+        Calls the function with each database and collects the returned values.
+
+        The scoped session of a database gets removed after the call, so that its connection gets returned to the
+        pool and the worker thread does not keep objects of it.
+
+        :param databases: dict of database name and :class:`~.Database`
+        :param function: function, which gets the database and returns the result for it
+        :param timeout: Seconds a database has to answer. A dict of database name and seconds sets
+                        single timeouts. None waits without limit.
+        :return: :class:`~.FanOutResult`
+        """
+        result = FanOutResult(databases.keys())
+        if getattr(_local, "worker", False):
+            for name, database in databases.items():
+                # Keeps the session of an enclosing call on the same database open
+                remove_session = not _is_thread_bound(database) and database not in _local.databases
+                _add_result(result, name, *self._call({}, name, database, function, remove_session))
+            return result
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="gw-sql-fan-out",
+                                                    initializer=_init_worker)
+            executor = self._executor
+
+        starts = {}
+        futures = {}
+        inline = []
+        for name, database in databases.items():
+            if _is_thread_bound(database):
+                inline.append((name, database))
+                continue
+            future = executor.submit(self._call, starts, name, database, function)
+            futures[future] = name
+
+        for name, database in inline:
+            # The session belongs to the calling thread, so it stays open
+            _add_result(result, name, *self._call(starts, name, database, function, remove_session=False))
+
+        pending = set(futures.keys())
+        while pending:
+            now = time.time()
+            deadlines = []
+            for future in list(pending):
+                name = futures[future]
+                seconds = _get_timeout(timeout, name)
+                if seconds is None or name not in starts:
+                    continue
+                if starts[name] + seconds <= now and not future.done():
+                    pending.discard(future)
+                    result.timed_out.append(name)
+                    log.warning("Database %s did not answer inside %ss" % (name, seconds))
+                else:
+                    deadlines.append(starts[name] + seconds)
+            if not pending:
+                break
+            wait_time = max(min(deadlines) - now, 0) if deadlines else None
+            if len(starts) < len(futures):
+                # Deadlines of queued calls start, when a worker picks them up
+                wait_time = _POLL_INTERVAL if wait_time is None else min(wait_time, _POLL_INTERVAL)
+            done, _ = wait(pending, timeout=wait_time, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.discard(future)
+                _add_result(result, futures[future], *future.result())
+
+        for mapping in (result.results, result.errors):
+            for name in [name for name in result.names if name in mapping.keys()]:
+                mapping.move_to_end(name)
+        result.timed_out.sort(key=result.names.index)
+        return result
+
+    def shutdown(self, wait=True):
+        """
+        Stops the worker threads. A later :func:`run` starts new ones.
+        """
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    @staticmethod
+    def _call(starts, name, database, function, remove_session=True):
+        start = starts[name] = time.time()
+        active = getattr(_local, "databases", [])
+        active.append(database)
+        try:
+            return None, function(database), time.time() - start
+        except Exception as e:
+            return e, None, time.time() - start
+        finally:
+            active.pop()
+            # The session of a Database is scoped per thread, so the worker must not keep it open
+            if remove_session and getattr(database, "is_built", False) and not hasattr(database, "dispose_async"):
+                database.session.remove()
+
+
+def get_fan_out_function(function_or_statement, named=False):
+    """
+    Returns the function to run for each database.
+
+    :param function_or_statement: function, which gets the database, or anything :func:`Database.fetch` accepts,
+                                  e.g. a select statement, table or mapped class. Strings are executed as textual SQL.
+    :param named: If True, rows of statements support access by column name
+    """
+    if callable(function_or_statement) and not isinstance(function_or_statement, type):
+        return function_or_statement
+
+    statement = function_or_statement
+    if isinstance(statement, str):
+        statement = text(statement)
+
+    def fetch(database):
+        if hasattr(database, "dispose_async"):
+            raise ValueError("Database %s has an asyncio engine. Use a function to query it." % database.name)
+        return database.fetch(statement, named=named)
+
+    return fetch
+
+
+def _init_worker():
+    _local.worker = True
+    _local.databases = []
+
+
+def _add_result(result, name, error, value, duration):
+    result.durations[name] = duration
+    if error is not None:
+        result.errors[name] = error
+        log.warning("Database %s failed: %s" % (name, error))
+    else:
+        result.results[name] = value
+
+
+def _is_thread_bound(database):
+    if hasattr(database, "dispose_async"):
+        return False
+    if hasattr(database, "pool"):
+        # Engines, e.g. the shards of a ShardedDatabase
+        return is_thread_bound(database.url, type(database.pool))
+    urls = getattr(database, "database_url", None)
+    if urls is None:
+        return False
+    pool_class = getattr(database, "engine_options", {}).get("poolclass")
+    return any(is_thread_bound(url, pool_class) for url in (urls if isinstance(urls, list) else [urls]))
+
+
+def _get_timeout(timeout, name):
+    if isinstance(timeout, dict):
+        return timeout.get(name)
+    return timeout
@@ -0,0 +1,92 @@
+import collections
+
+from sqlalchemy import select
+from sqlalchemy.orm import Query
+from sqlalchemy.sql.expression import Select, TextClause
+
+from groundwork_database.patterns.gw_sql_utils import get_table
+
+
+def get_select(query_or_model, columns=None):
+    """
+    Returns a Core select for the given query or model.
+
+    :param query_or_model: select statement, textual statement, query, sqlalchemy table, mapped class or
+                           :class:`~.DatabaseModel`
+    :param columns: names of the columns to select from a table or model. Default are all columns.
+    :return: sqlalchemy select
+    """
+    if isinstance(query_or_model, Query):
+        statement = query_or_model.statement
+    elif isinstance(query_or_model, (Select, TextClause)):
+        statement = query_or_model
+    else:
+        table = get_table(query_or_model)
+        if columns is None:
+            return select(*table.columns)
+        return select(*[table.columns[column] for column in columns])
+
+    if columns is not None:
+        raise ValueError("columns can only be given for tables and models")
+    return statement
+
+
+def fetch_rows(connection, statement, named=False):
+    """
+    Executes a select and returns all rows without creating ORM objects.
+
+    :param connection: sqlalchemy connection
+    :param statement: sqlalchemy select
+    :param named: If True, rows support access by column name (``row.name``), otherwise they are plain tuples
+    :return: list of rows
+    """
+    result = connection.execute(statement)
+    if named:
+        return result.all()
+    return [tuple(row) for row in result]
+
+
+def fetch_arrays(connection, statement, chunk_size=10000, dtypes=None, supports_streaming=False):
+    """
+    Executes a select and returns the values of each column as NumPy array.
+
+    Rows get fetched in chunks of chunk_size rows, which are converted column by column.
+    So no row objects for the complete result are held in memory.
+
+    Without a dtype, NumPy infers it from the values. Columns containing NULL values get the dtype object.
+
+    :param connection: sqlalchemy connection
+    :param statement: sqlalchemy select
+    :param chunk_size: Number of rows, which get fetched and converted at once
+    :param dtypes: dict of column names and NumPy dtypes
+    :param supports_streaming: If True, rows get fetched by a server-side cursor
+    :return: OrderedDict of column names and NumPy arrays
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("fetch_arrays needs NumPy. Install it by 'pip install numpy'")
+
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1")
+    dtypes = dtypes or {}
+
+    if supports_streaming:
+        connection = connection.execution_options(stream_results=True, max_row_buffer=chunk_size)
+    result = connection.execute(statement)
+    names = list(result.keys())
+    chunks = collections.OrderedDict((name, []) for name in names)
+    try:
+        for partition in result.partitions(chunk_size):
+            for name, values in zip(names, zip(*partition)):
+                chunks[name].append(numpy.array(values, dtype=dtypes.get(name)))
+    finally:
+        result.close()
+
+    arrays = collections.OrderedDict()
+    for name, column_chunks in chunks.items():
+        if column_chunks:
+            arrays[name] = numpy.concatenate(column_chunks)
+        else:
+            arrays[name] = numpy.array([], dtype=dtypes.get(name))
+    return arrays
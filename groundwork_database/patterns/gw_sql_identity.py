@@ -0,0 +1,222 @@
+import collections
+import threading
+import time
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Query, Session, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+#: Key of the identity cache inside ``Session.info``
+IDENTITY_CACHE_KEY = "identity_cache"
+_PENDING_KEY = "identity_cache_pending"
+
+
+class IdentityCache:
+    """
+    Second-level cache for primary key loads, shared by all sessions of a database.
+
+    Only classes, which are enabled (see ``DatabaseClass.register(..., identity_cache=True)``), get cached.
+    The cache stores the loaded column values and not the objects itself. A hit creates a new object
+    inside the session of the caller.
+
+    Objects changed or deleted by a flush get evicted on flush and again on commit or rollback.
+    Update and delete statements executed by a session evict all entries of the affected classes.
+    A load, which was running while an object of its class got evicted, does not get stored, as it may have read
+    the old row. Writes, which do not use a session of the database (e.g. raw engine connections), are not
+    detected. Their changes are visible after the entries have expired.
+
+    :param max_entries: Maximum number of cached objects. Least recently used ones get evicted first.
+    :param ttl: Seconds after which a cached object expires. None keeps objects until they get evicted.
+    """
+
+    def __init__(self, max_entries=10000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # Values are (column values, expiry time)
+        self._entries = collections.OrderedDict()
+        self._classes = set()
+        # Invalidation generation per class. Changes, whenever objects of the class get evicted.
+        self._generations = collections.defaultdict(int)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def enable(self, clazz):
+        self._classes.add(clazz)
+
+    def disable(self, clazz):
+        self._classes.discard(clazz)
+        self.evict(clazz)
+
+    def is_enabled(self, clazz):
+        return clazz in self._classes
+
+    def attach(self, session_factory):
+        event.listen(session_factory, "after_flush", self._after_flush)
+        event.listen(session_factory, "after_commit", self._after_transaction)
+        event.listen(session_factory, "after_rollback", self._after_transaction)
+        event.listen(session_factory, "do_orm_execute", self._do_orm_execute)
+
+    def get(self, session, clazz, ident, load):
+        """
+        Returns the object of the given class and primary key.
+
+        The identity map of the session is used first, then the cache. If both miss, ``load()`` gets called
+        and its result gets stored.
+
+        :param session: session, which gets the object
+        :param clazz: mapped class
+        :param ident: primary key value or tuple of values
+        :param load: function, which loads the object from the database
+        """
+        mapper = inspect(clazz)
+        primary_key = tuple(ident) if isinstance(ident, (tuple, list)) else (ident,)
+        identity_key = mapper.identity_key_from_primary_key(primary_key)
+        instance = session.identity_map.get(identity_key)
+        if instance is not None:
+            return instance
+
+        key = (clazz, primary_key)
+        values = None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] < time.time():
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is not None:
+                values = entry[0]
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            generation = self._generations[clazz]
+
+        if values is None:
+            instance = load()
+            if instance is not None:
+                self._store(key, mapper, instance, generation)
+            return instance
+
+        instance = mapper.class_manager.new_instance()
+        for attribute, value in values.items():
+            set_committed_value(instance, attribute, value)
+        make_transient_to_detached(instance)
+        return session.merge(instance, load=False)
+
+    def _store(self, key, mapper, instance, generation):
+        state = inspect(instance)
+        if state.modified or state.expired_attributes:
+            return
+        values = {}
+        for attribute in mapper.column_attrs:
+            if attribute.key not in state.dict:
+                return
+            values[attribute.key] = state.dict[attribute.key]
+        with self._lock:
+            # Objects of the class got evicted while loading, so the loaded row may be outdated
+            if self._generations[key[0]] != generation:
+                return
+            self._entries[key] = (values, time.time() + self.ttl if self.ttl is not None else None)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def evict(self, clazz, primary_key=None):
+        """
+        Removes a single object or all objects of a class from the cache.
+        """
+        with self._lock:
+            self._generations[clazz] += 1
+            if primary_key is not None:
+                keys = [(clazz, tuple(primary_key))] if (clazz, tuple(primary_key)) in self._entries else []
+            else:
+                keys = [key for key in self._entries.keys() if key[0] is clazz]
+            for key in keys:
+                del self._entries[key]
+            self.invalidations += len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for clazz in list(self._generations.keys()):
+                self._generations[clazz] += 1
+
+    def to_dict(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": float(self.hits) / requests if requests else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+    def _after_flush(self, session, flush_context):
+        pending = session.info.setdefault(_PENDING_KEY, set())
+        for instance in list(session.dirty) + list(session.deleted):
+            clazz = type(instance)
+            if clazz in self._classes:
+                primary_key = tuple(inspect(clazz).primary_key_from_instance(instance))
+                pending.add((clazz, primary_key))
+                self.evict(clazz, primary_key)
+
+    def _after_transaction(self, session):
+        for clazz, primary_key in session.info.pop(_PENDING_KEY, ()):
+            self.evict(clazz, primary_key)
+
+    def _do_orm_execute(self, orm_execute_state):
+        if orm_execute_state.is_update or orm_execute_state.is_delete:
+            pending = orm_execute_state.session.info.setdefault(_PENDING_KEY, set())
+            for mapper in orm_execute_state.all_mappers:
+                if mapper.class_ in self._classes:
+                    self.evict(mapper.class_)
+                    pending.add((mapper.class_, None))
+
+
+class CachingSession(Session):
+    """
+    Session, whose ``get()`` uses the :class:`~.IdentityCache` stored in ``Session.info``, if the class is enabled.
+
+    Loads for the cache get ``bind_arguments={"primary": True}``, so that a session, which routes reads to
+    replicas, does not store outdated rows of a replica in the cache shared by all sessions.
+    """
+
+    def get(self, entity, ident, **kwargs):
+        cache = self.info.get(IDENTITY_CACHE_KEY)
+        # scoped_session passes all keyword arguments with their defaults
+        if cache is None or any(kwargs.values()) or not isinstance(entity, type) or not cache.is_enabled(entity) \
+                or isinstance(ident, dict):
+            return super(CachingSession, self).get(entity, ident, **kwargs)
+        return cache.get(self, entity, ident,
+                         lambda: super(CachingSession, self).get(entity, ident, bind_arguments={"primary": True}))
+
+
+class CachingQuery(Query):
+    """
+    Query, whose ``get()`` uses the :class:`~.IdentityCache` by :func:`CachingSession.get`,
+    if the queried class is enabled.
+    """
+
+    def get(self, ident):
+        clazz = self._get_cacheable_class()
+        if clazz is None or not isinstance(self.session, CachingSession):
+            return super(CachingQuery, self).get(ident)
+        return self.session.get(clazz, ident)
+
+    def _get_cacheable_class(self):
+        descriptions = self.column_descriptions
+        if len(descriptions) != 1 or getattr(self, "_for_update_arg", None) is not None or self._with_options:
+            return None
+        description = descriptions[0]
+        if description["aliased"] or description["expr"] is not description["entity"]:
+            return None
+        return description["entity"]
@@ -0,0 +1,230 @@
+import collections
+import logging
+import re
+import threading
+import time
+
+from sqlalchemy import Index, inspect, text
+
+from groundwork_database.patterns.gw_sql_pool import is_thread_bound
+
+log = logging.getLogger(__name__)
+
+#: Status of declared indexes
+INDEX_PENDING = "pending"
+INDEX_EXISTS = "exists"
+INDEX_CREATED = "created"
+INDEX_NO_TABLE = "no_table"
+INDEX_FAILED = "failed"
+
+
+class _DeclaredIndex:
+    def __init__(self, index, columns, where):
+        self.index = index
+        self.columns = columns
+        self.where = where
+        self.status = INDEX_PENDING
+        self.error = None
+        self.build_time = None
+
+    def to_dict(self):
+        return {
+            "name": self.index.name,
+            "table": self.index.table.name,
+            "columns": self.columns,
+            "unique": self.index.unique,
+            "where": self.where,
+            "status": self.status,
+            "error": self.error,
+            "build_time": self.build_time,
+        }
+
+
+class IndexManager:
+    """
+    Manages the indexes, which registered classes declare for their lookups and sort orders.
+
+    Declared indexes are not part of the metadata, so ``create_all()`` does not wait for them.
+    :func:`ensure` creates missing ones by a background thread instead, on PostgreSQL with
+    ``CREATE INDEX CONCURRENTLY``, so that writes to the table are not blocked either.
+    Engines, whose connections can not be used by another thread (e.g. in-memory SQLite), build synchronously.
+
+    An index declaration is one of:
+
+    * a column name, e.g. ``"name"``
+    * a list of column names for a composite index. A leading "-" sorts descending, e.g. ``["name", "-created"]``
+    * a dict with columns and optional name, unique and where (SQL condition of a partial index)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._indexes = collections.OrderedDict()
+        self._thread = None
+
+    def declare(self, table, declarations):
+        """
+        Adds index declarations for a table.
+        All declarations get validated first, so that an invalid one does not leave the others registered.
+
+        :param table: sqlalchemy table
+        :param declarations: list of index declarations
+        :return: list of index names
+        """
+        declared_indexes = [_get_declared_index(table, declaration) for declaration in declarations]
+        names = [declared.index.name for declared in declared_indexes]
+        with self._lock:
+            for name in names:
+                if name in self._indexes.keys() or names.count(name) > 1:
+                    raise ValueError("Index %s is already declared" % name)
+            for declared in declared_indexes:
+                self._indexes[declared.index.name] = declared
+        return names
+
+    def remove(self, table):
+        """
+        Removes the declarations of a table. Existing indexes stay in the database.
+        """
+        with self._lock:
+            for name in [name for name, declared in self._indexes.items() if declared.index.table is table]:
+                del self._indexes[name]
+
+    def ensure(self, engine, wait=False):
+        """
+        Creates missing declared indexes by a background thread.
+
+        :param engine: sqlalchemy engine
+        :param wait: If True, the indexes get created by the calling thread. Always the case for engines,
+                     whose connections are bound to threads (in-memory SQLite, SingletonThreadPool and StaticPool),
+                     as a background thread would not see their tables.
+        """
+        if wait or is_thread_bound(engine.url, type(engine.pool)):
+            self.join()
+            self._build(engine)
+            return
+
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._build, args=(engine,), name="gw-sql-index-builder")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def join(self):
+        with self._lock:
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _build(self, engine):
+        while True:
+            with self._lock:
+                pending = [declared for declared in self._indexes.values()
+                           if declared.status in (INDEX_PENDING, INDEX_NO_TABLE)]
+            if not pending:
+                return
+            inspector = inspect(engine)
+            for declared in pending:
+                self._build_index(engine, inspector, declared)
+            with self._lock:
+                # Declarations added while building get handled by the next round
+                if not any(declared.status == INDEX_PENDING for declared in self._indexes.values()):
+                    return
+
+    def _build_index(self, engine, inspector, declared):
+        table = declared.index.table
+        try:
+            if not inspector.has_table(table.name, schema=table.schema):
+                declared.status = INDEX_NO_TABLE
+                return
+            existing = [index["name"] for index in inspector.get_indexes(table.name, schema=table.schema)]
+            if declared.index.name in existing:
+                declared.status = INDEX_EXISTS
+                return
+            start = time.time()
+            # CREATE INDEX CONCURRENTLY of PostgreSQL must not run inside a transaction
+            with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+                declared.index.create(connection)
+            declared.build_time = time.time() - start
+            declared.status = INDEX_CREATED
+            log.info("Index %s created in %.2fs" % (declared.index.name, declared.build_time))
+        except Exception as e:
+            declared.status = INDEX_FAILED
+            declared.error = str(e)
+            log.error("Index %s could not be created: %s" % (declared.index.name, e))
+
+    def status(self):
+        """
+        Returns the declared indexes with their status: pending, exists, created, no_table or failed.
+        """
+        with self._lock:
+            return [declared.to_dict() for declared in self._indexes.values()]
+
+    def unused(self, statements):
+        """
+        Returns the declared indexes, whose leading column is not used by any of the given statements
+        for filtering, joining or sorting its table.
+
+        This is a heuristic on the statement text and does not check the plans of the database.
+
+        :param statements: statements of the query log, e.g. of :func:`Database.query_stats`
+        :return: list of dicts like :func:`status`
+        """
+        usages = [_get_used_columns(statement) for statement in statements]
+        unused = []
+        with self._lock:
+            declared_indexes = list(self._indexes.values())
+        for declared in declared_indexes:
+            table = declared.index.table.name
+            column = declared.columns[0].lstrip("-")
+            if not any(table in tables and column in columns for tables, columns in usages):
+                unused.append(declared.to_dict())
+        return unused
+
+
+def _get_declared_index(table, declaration):
+    if isinstance(declaration, dict):
+        options = dict(declaration)
+        columns = options.pop("columns")
+    else:
+        options = {}
+        columns = declaration
+    if isinstance(columns, str):
+        columns = [columns]
+    columns = list(columns)
+
+    expressions = []
+    for column in columns:
+        name = column.lstrip("-")
+        if name not in table.columns:
+            raise ValueError("%s is not a column of table %s" % (name, table.name))
+        expressions.append(table.columns[name].desc() if column.startswith("-") else table.columns[name])
+
+    where = options.pop("where", None)
+    name = options.pop("name", None) or "ix_%s_%s" % (table.name, "_".join(column.lstrip("-") for column in columns))
+    unique = options.pop("unique", False)
+    if options:
+        raise ValueError("Unknown index options: %s" % ", ".join(options.keys()))
+
+    dialect_options = {"postgresql_concurrently": True}
+    if where is not None:
+        dialect_options["postgresql_where"] = text(where)
+        dialect_options["sqlite_where"] = text(where)
+    index = Index(name, *expressions, unique=unique, **dialect_options)
+    # The index gets bound to the table by its columns. Remove it from the metadata, so that
+    # create_all() does not create it synchronously.
+    table.indexes.discard(index)
+    return _DeclaredIndex(index, columns, where)
+
+
+_CLAUSES = re.compile(r"\b(?:WHERE|ON|ORDER BY|GROUP BY)\b(.*?)(?=\b(?:LIMIT|OFFSET|FROM|JOIN|UNION|RETURNING)\b|$)",
+                      re.IGNORECASE | re.DOTALL)
+_IDENTIFIERS = re.compile(r"\b(\w+)\.(\w+)\b|\b(\w+)\b")
+_TABLES = re.compile(r"\b(?:FROM|JOIN|UPDATE|INTO)\s+(\w+)", re.IGNORECASE)
+
+
+def _get_used_columns(statement):
+    tables = set(_TABLES.findall(statement))
+    columns = set()
+    for clause in _CLAUSES.findall(statement):
+        for qualified_table, qualified_column, column in _IDENTIFIERS.findall(clause):
+            columns.add(qualified_column or column)
+    return tables, columns
@@ -0,0 +1,269 @@
+import bisect
+import collections
+import hashlib
+import logging
+import re
+import threading
+import time
+import weakref
+
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r"\s+")
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PARAMETERS = re.compile(r"%\(\w+\)s|%s|:\w+|\$\d+")
+_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_VALUES = re.compile(r"(\(\?\))(?:\s*,\s*\(\?\))+")
+
+#: Upper bounds of the latency histogram buckets in seconds: 0.1ms, 0.2ms, 0.4ms, ... ~52s
+HISTOGRAM_BOUNDS = [0.0001 * 2 ** i for i in range(20)]
+
+# QueryStatistics per engine, so that databases sharing an engine also share their statistics
+_statistics = weakref.WeakKeyDictionary()
+_statistics_lock = threading.Lock()
+
+
+def normalize_statement(statement):
+    """
+    Returns the statement with literals and bind parameters replaced by ``?``.
+    IN lists and multi VALUES lists get collapsed, so that they do not depend on the number of parameters.
+    """
+    statement = _WHITESPACE.sub(" ", statement).strip()
+    statement = _LITERALS.sub("?", statement)
+    statement = _PARAMETERS.sub("?", statement)
+    statement = _LISTS.sub("(?)", statement)
+    statement = _VALUES.sub(r"\1", statement)
+    return statement
+
+
+def get_fingerprint(normalized_statement):
+    return hashlib.md5(normalized_statement.encode("utf-8")).hexdigest()[:16]
+
+
+def get_query_statistics(engine, slow_query_threshold=None):
+    """
+    Returns the :class:`~.QueryStatistics` of an engine. They get attached to the engine, if not done yet.
+
+    :param engine: sqlalchemy engine
+    :param slow_query_threshold: Seconds, after which a statement gets logged as slow query.
+                                 Lowers the threshold of already attached statistics, if smaller.
+    """
+    with _statistics_lock:
+        statistics = _statistics.get(engine)
+        if statistics is None:
+            statistics = _statistics[engine] = QueryStatistics(engine, slow_query_threshold)
+        elif slow_query_threshold is not None and (statistics.slow_query_threshold is None or
+                                                   slow_query_threshold < statistics.slow_query_threshold):
+            statistics.slow_query_threshold = slow_query_threshold
+        return statistics
+
+
+def sort_statements(statements, order_by="total_time", limit=None):
+    """
+    Sorts statistics of statements descending. Unknown values (None) get sorted last.
+
+    :param statements: list of dicts, see :func:`QueryStatistics.statements`
+    :param order_by: key to sort by
+    :param limit: maximum number of statements to return
+    :return: list of dicts
+    """
+    statements.sort(key=lambda statement: (statement[order_by] is not None, statement[order_by] or 0), reverse=True)
+    return statements[:limit] if limit is not None else statements
+
+
+def summarize(query_statistics):
+    """
+    Returns count, total time and latency percentiles p50/p95/p99 over all statements of
+    the given :class:`~.QueryStatistics` objects.
+    """
+    histogram = LatencyHistogram()
+    total_time = 0.0
+    for statistics in query_statistics:
+        snapshot = statistics.snapshot()
+        histogram.merge(snapshot["histogram"])
+        total_time += snapshot["total_time"]
+    return {
+        "count": histogram.count,
+        "total_time": total_time,
+        "p50": histogram.percentile(50),
+        "p95": histogram.percentile(95),
+        "p99": histogram.percentile(99),
+    }
+
+
+class LatencyHistogram:
+    """
+    Histogram of latencies with exponential buckets, see :data:`HISTOGRAM_BOUNDS`.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.count = 0
+
+    def add(self, latency):
+        self.buckets[bisect.bisect_left(HISTOGRAM_BOUNDS, latency)] += 1
+        self.count += 1
+
+    def merge(self, histogram):
+        for index, amount in enumerate(histogram.buckets):
+            self.buckets[index] += amount
+        self.count += histogram.count
+
+    def percentile(self, percent):
+        """
+        Returns the upper bound of the bucket, which contains the given percentile.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = self.count * percent / 100.0
+        seen = 0
+        for index, amount in enumerate(self.buckets):
+            seen += amount
+            if seen >= rank:
+                return HISTOGRAM_BOUNDS[index] if index < len(HISTOGRAM_BOUNDS) else float("inf")
+        return float("inf")
+
+
+class StatementStatistics:
+    def __init__(self, fingerprint, statement):
+        self.fingerprint = fingerprint
+        self.statement = statement
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        # None, until the driver has reported a rowcount for the statement
+        self.rows = None
+        self.histogram = LatencyHistogram()
+
+    def add(self, duration, rows):
+        self.count += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+        if rows is not None:
+            self.rows = (self.rows or 0) + rows
+        self.histogram.add(duration)
+
+    def to_dict(self):
+        return {
+            "fingerprint": self.fingerprint,
+            "statement": self.statement,
+            "count": self.count,
+            "total_time": self.total_time,
+            "avg_time": self.total_time / self.count if self.count else 0.0,
+            "max_time": self.max_time,
+            "p50": self.histogram.percentile(50),
+            "p95": self.histogram.percentile(95),
+            "p99": self.histogram.percentile(99),
+            "rows": self.rows,
+        }
+
+
+class QueryStatistics:
+    """
+    Collects execution statistics per normalized statement of an engine.
+
+    Rows are taken from the cursor rowcount. Drivers, which do not report it for selects (like sqlite3),
+    only count rows of insert, update and delete statements. Rows of those selects are None.
+
+    :param engine: sqlalchemy engine
+    :param slow_query_threshold: Seconds, after which a statement gets stored in the slow query log
+    :param slow_query_log_size: Maximum number of entries of the slow query log
+    """
+
+    def __init__(self, engine, slow_query_threshold=None, slow_query_log_size=100):
+        self.slow_query_threshold = slow_query_threshold
+        self._lock = threading.Lock()
+        self._statements = {}
+        self._normalized = {}
+        self._slow_queries = collections.deque(maxlen=slow_query_log_size)
+
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        event.listen(engine, "handle_error", self._handle_error)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start_time", []).append((cursor, time.time()))
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        duration = time.time() - conn.info["query_start_time"].pop()[1]
+
+        # Normalizing is the expensive part, but the number of different statements is small.
+        normalized = self._normalized.get(statement)
+        if normalized is None:
+            normalized_statement = normalize_statement(statement)
+            normalized = (get_fingerprint(normalized_statement), normalized_statement)
+            if len(self._normalized) < 10000:
+                self._normalized[statement] = normalized
+        fingerprint, normalized_statement = normalized
+
+        with self._lock:
+            statistics = self._statements.get(fingerprint)
+            if statistics is None:
+                statistics = self._statements[fingerprint] = StatementStatistics(fingerprint, normalized_statement)
+            statistics.add(duration, cursor.rowcount if cursor.rowcount >= 0 else None)
+
+            if self.slow_query_threshold is not None and duration >= self.slow_query_threshold:
+                self._slow_queries.append({
+                    "fingerprint": fingerprint,
+                    "statement": statement,
+                    "duration": duration,
+                    "time": time.time(),
+                })
+        if self.slow_query_threshold is not None and duration >= self.slow_query_threshold:
+            log.warning("Slow query (%.4fs, %s): %s" % (duration, fingerprint, statement))
+
+    def _handle_error(self, exception_context):
+        # Failed statements do not reach after_cursor_execute, so their start time gets dropped here.
+        # Errors raised later, e.g. while fetching rows, belong to a statement, whose start time is already gone.
+        context = exception_context.execution_context
+        if exception_context.connection is None or context is None:
+            return
+        starts = exception_context.connection.info.get("query_start_time")
+        if starts and starts[-1][0] is context.cursor:
+            starts.pop()
+
+    def statements(self, order_by="total_time", limit=None):
+        """
+        Returns statistics per normalized statement, sorted descending.
+
+        :param order_by: key to sort by, e.g. "total_time", "count", "max_time", "p99" or "rows"
+        :param limit: maximum number of statements to return
+        :return: list of dicts
+        """
+        with self._lock:
+            statements = [statistics.to_dict() for statistics in self._statements.values()]
+        return sort_statements(statements, order_by, limit)
+
+    def slow_queries(self):
+        """
+        Returns the entries of the slow query log, oldest first.
+        """
+        with self._lock:
+            return list(self._slow_queries)
+
+    def snapshot(self):
+        """
+        Returns the latency histogram merged over all statements and their total time.
+
+        :return: dict with a :class:`~.LatencyHistogram` as "histogram" and "total_time"
+        """
+        histogram = LatencyHistogram()
+        total_time = 0.0
+        with self._lock:
+            for statement in self._statements.values():
+                histogram.merge(statement.histogram)
+                total_time += statement.total_time
+        return {"histogram": histogram, "total_time": total_time}
+
+    def summary(self):
+        """
+        Returns count, total time and latency percentiles over all statements.
+        """
+        return summarize([self])
+
+    def reset(self):
+        with self._lock:
+            self._statements.clear()
+            self._slow_queries.clear()
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import weakref
+
+from groundwork.docstring import parse
+from sqlalchemy.orm.attributes import InstrumentedAttribute
+
+log = logging.getLogger(__name__)
+
+# Introspected metadata per class, so that a class registered in several databases gets parsed once
+_metadata = weakref.WeakKeyDictionary()
+_metadata_lock = threading.Lock()
+
+# IntrospectionCache per file path
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_class_metadata(clazz, cache_path=None):
+    """
+    Returns description and parameters of a class, taken from its docstring and its columns.
+
+    The result is memoized per class. If a cache_path is given, parsed docstrings are persisted there as well,
+    so that they do not get parsed again after a restart, as long as docstring and attributes are unchanged.
+
+    :param clazz: mapped class
+    :param cache_path: path of a json file used as :class:`~.IntrospectionCache` or None
+    :return: dict with description and parameters
+    """
+    with _metadata_lock:
+        metadata = _metadata.get(clazz)
+    if metadata is not None:
+        return metadata
+
+    cache = get_introspection_cache(cache_path) if cache_path is not None else None
+    key = get_class_key(clazz) if cache is not None else None
+    metadata = cache.get(key) if cache is not None else None
+    if metadata is None:
+        metadata = _parse_class(clazz)
+        if cache is not None:
+            cache.set(key, metadata)
+
+    with _metadata_lock:
+        return _metadata.setdefault(clazz, metadata)
+
+
+def get_class_key(clazz):
+    """
+    Returns a key, which changes if docstring or attributes of the class change.
+    """
+    # Docstring and attribute names are the only input of the introspection. Hashing them is much cheaper
+    # than reading the source file of the class.
+    source = "%s\n%s" % (clazz.__doc__, sorted(clazz.__dict__.keys()))
+    return "%s.%s:%s" % (clazz.__module__, clazz.__name__, hashlib.sha256(source.encode("utf-8")).hexdigest()[:16])
+
+
+def get_introspection_cache(path):
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = _caches[path] = IntrospectionCache(path)
+        return cache
+
+
+def _parse_class(clazz):
+    parsed_doc = parse(clazz.__doc__)
+    description = None
+    if parsed_doc.short_description is not None:
+        description = parsed_doc.short_description + '\n'
+    if parsed_doc.long_description is not None:
+        description = (description or '') + parsed_doc.long_description
+
+    parameters = {}
+    for parameter in parsed_doc.params:
+        parameters[parameter.arg_name] = {
+            'name': parameter.arg_name,
+            'description': parameter.description,
+            'type': parameter.type_name
+        }
+
+    for element_key in clazz.__dict__.keys():
+        element = getattr(clazz, element_key)
+        if isinstance(element, InstrumentedAttribute) and element.key not in parameters.keys():
+            parameters[element.key] = {
+                'name': element.key,
+                'description': '',
+                'type': ''
+            }
+    return {"description": description, "parameters": parameters}
+
+
+class IntrospectionCache:
+    """
+    Json file, which stores the introspected metadata of classes by :func:`get_class_key`.
+
+    The file gets read on first usage and rewritten on each new entry. Errors while reading or writing
+    only get logged, because the cache is not needed for correct results.
+
+    :param path: path of the json file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = None
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as cache_file:
+                self._entries = json.load(cache_file)
+        except (IOError, OSError, ValueError) as e:
+            log.warning("Introspection cache %s could not be read: %s" % (self.path, e))
+
+    def get(self, key):
+        with self._lock:
+            self._load()
+            return self._entries.get(key)
+
+    def set(self, key, metadata):
+        with self._lock:
+            self._load()
+            self._entries[key] = metadata
+            temp_path = "%s.%s.tmp" % (self.path, os.getpid())
+            try:
+                with open(temp_path, "w") as cache_file:
+                    json.dump(self._entries, cache_file)
+                os.replace(temp_path, self.path)
+            except (IOError, OSError) as e:
+                log.warning("Introspection cache %s could not be written: %s" % (self.path, e))
@@ -0,0 +1,97 @@
+import collections
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+
+from groundwork_database.patterns.gw_sql_instrumentation import normalize_statement
+
+log = logging.getLogger(__name__)
+
+
+class NPlusOneDetector:
+    """
+    Detects N+1 queries: the same select executed again and again by one session inside one transaction,
+    typically by lazy loading a relationship for each object of a list.
+
+    Selects of a session get counted per relationship (lazy loads), per class (loads of expired or deferred
+    attributes) or per statement without parameters (all others). Counters get reset at the end of the
+    transaction of the session. If a counter reaches the threshold, the detection gets logged as warning
+    or raised as :class:`~.NPlusOneException`.
+
+    :param threshold: Number of equal selects inside one transaction, which is reported
+    :param raise_errors: If True, an exception gets raised instead of logging a warning
+    :param report_size: Maximum number of detections, which are kept for :func:`detections`
+    """
+
+    def __init__(self, threshold=10, raise_errors=False, report_size=100):
+        self.threshold = threshold
+        self.raise_errors = raise_errors
+        self._lock = threading.Lock()
+        self._detections = collections.deque(maxlen=report_size)
+        self._counts_key = "n_plus_one_counts_%s" % id(self)
+
+    def attach(self, session_factory):
+        event.listen(session_factory, "do_orm_execute", self._do_orm_execute)
+        event.listen(session_factory, "after_transaction_end", self._after_transaction_end)
+
+    def detections(self):
+        """
+        Returns the detected N+1 queries, oldest first.
+        Each one is a dict with model, relationship (None, if not a lazy load), statement, count and time.
+        """
+        with self._lock:
+            return list(self._detections)
+
+    def _do_orm_execute(self, orm_execute_state):
+        if not orm_execute_state.is_select:
+            return
+
+        model = relationship = None
+        if orm_execute_state.is_relationship_load and orm_execute_state.lazy_loaded_from is not None:
+            path = orm_execute_state.loader_strategy_path
+            model = orm_execute_state.lazy_loaded_from.class_
+            relationship = path[-1].key if path is not None and len(path) else None
+            key = ("relationship", model, relationship)
+        elif orm_execute_state.is_column_load:
+            model = orm_execute_state.bind_mapper.class_ if orm_execute_state.bind_mapper is not None else None
+            key = ("column", model)
+        else:
+            key = ("statement", str(orm_execute_state.statement))
+
+        counts = orm_execute_state.session.info.setdefault(self._counts_key, {})
+        count = counts[key] = counts.get(key, 0) + 1
+        if count != self.threshold:
+            return
+
+        if model is None and orm_execute_state.bind_mapper is not None:
+            model = orm_execute_state.bind_mapper.class_
+        detection = {
+            "model": model.__name__ if model is not None else None,
+            "relationship": relationship,
+            "statement": normalize_statement(str(orm_execute_state.statement)),
+            "count": count,
+            "time": time.time(),
+        }
+        with self._lock:
+            self._detections.append(detection)
+
+        if relationship is not None:
+            message = "N+1 queries: relationship %s.%s got lazy loaded %s times inside one transaction. " \
+                      "Load it eagerly, e.g. by options(selectinload(%s.%s))" \
+                      % (detection["model"], relationship, count, detection["model"], relationship)
+        else:
+            message = "N+1 queries: statement of %s executed %s times inside one transaction: %s" \
+                      % (detection["model"], count, detection["statement"])
+        if self.raise_errors:
+            raise NPlusOneException(message)
+        log.warning(message)
+
+    def _after_transaction_end(self, session, transaction):
+        if transaction.parent is None:
+            session.info.pop(self._counts_key, None)
+
+
+class NPlusOneException(Exception):
+    pass
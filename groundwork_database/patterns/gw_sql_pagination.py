@@ -0,0 +1,164 @@
+import base64
+import datetime
+import decimal
+import json
+
+from sqlalchemy import and_, inspect, or_, tuple_
+
+NEXT = "next"
+PREVIOUS = "previous"
+
+
+class Page:
+    """
+    A page of results of :func:`paginate`.
+
+    The cursors are opaque strings, which can be passed to :func:`paginate` to get the next or previous page.
+    They are None, if there is no such page.
+    """
+
+    def __init__(self, items, next_cursor, previous_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def paginate(query, clazz, page_size=20, cursor=None, order_by=None):
+    """
+    Returns a page of a query by keyset pagination.
+
+    Instead of skipping rows by OFFSET, a page starts after the sort key values of the last row of the previous
+    page. With an index on the sort key, each page costs the same, independent of its position.
+    The primary key is always used as last sort key, so that the order is unique.
+    Sort key columns must not contain NULL values.
+
+    :param query: query of the mapped class, may contain filters but no ordering
+    :param clazz: mapped class
+    :param page_size: Number of items per page
+    :param cursor: next_cursor or previous_cursor of a page. None returns the first page.
+    :param order_by: list of attribute names to sort by. A leading "-" sorts descending, e.g. ["-created", "name"].
+                     Default is the primary key.
+    :return: :class:`~.Page`
+    """
+    if page_size < 1:
+        raise ValueError("page_size must be at least 1")
+
+    keys = _get_sort_keys(clazz, order_by)
+    signature = [name if ascending else "-" + name for name, ascending in keys]
+    columns = [(getattr(clazz, name), ascending) for name, ascending in keys]
+
+    direction = NEXT
+    if cursor is not None:
+        direction, values = _decode_cursor(cursor, signature)
+        query = query.filter(_get_seek_condition(columns, values, direction))
+
+    forward = direction == NEXT
+    ordering = [column.asc() if ascending == forward else column.desc() for column, ascending in columns]
+    items = query.order_by(*ordering).limit(page_size + 1).all()
+    has_more = len(items) > page_size
+    items = items[:page_size]
+    if not forward:
+        items.reverse()
+
+    if forward:
+        has_next, has_previous = has_more, cursor is not None
+    else:
+        has_next, has_previous = True, has_more
+
+    next_cursor = previous_cursor = None
+    if items:
+        if has_next:
+            next_cursor = _encode_cursor(NEXT, _get_values(items[-1], keys), signature)
+        if has_previous:
+            previous_cursor = _encode_cursor(PREVIOUS, _get_values(items[0], keys), signature)
+    return Page(items, next_cursor, previous_cursor)
+
+
+def _get_sort_keys(clazz, order_by):
+    mapper = inspect(clazz)
+    primary_keys = [mapper.get_property_by_column(column).key for column in mapper.primary_key]
+    keys = []
+    for name in order_by or []:
+        ascending = not name.startswith("-")
+        name = name.lstrip("-")
+        if name not in mapper.column_attrs.keys():
+            raise ValueError("%s is not a column of %s" % (name, clazz.__name__))
+        keys.append((name, ascending))
+    used = [name for name, _ in keys]
+    keys.extend((name, True) for name in primary_keys if name not in used)
+    return keys
+
+
+def _get_seek_condition(columns, values, direction):
+    forward = direction == NEXT
+    if all(ascending == columns[0][1] for _, ascending in columns):
+        # Row value comparison can use a composite index directly
+        left = tuple_(*[column for column, _ in columns])
+        right = tuple_(*values)
+        return left > right if columns[0][1] == forward else left < right
+
+    # Mixed directions: (a > x) OR (a = x AND b < y) OR ...
+    conditions = []
+    for index, (column, ascending) in enumerate(columns):
+        equal = [columns[i][0] == values[i] for i in range(index)]
+        seek = column > values[index] if ascending == forward else column < values[index]
+        conditions.append(and_(*(equal + [seek])))
+    return or_(*conditions)
+
+
+def _get_values(item, keys):
+    return [getattr(item, name) for name, _ in keys]
+
+
+def _encode_cursor(direction, values, signature):
+    data = json.dumps({"d": direction, "k": signature, "v": [_encode_value(value) for value in values]},
+                      separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor, signature):
+    try:
+        data = base64.urlsafe_b64decode((cursor + "=" * (-len(cursor) % 4)).encode("ascii"))
+        data = json.loads(data.decode("utf-8"))
+        direction, keys, values = data["d"], data["k"], [_decode_value(value) for value in data["v"]]
+    except (ValueError, TypeError, KeyError, AttributeError):
+        raise ValueError("Invalid cursor")
+    if keys != signature or direction not in (NEXT, PREVIOUS) or len(values) != len(signature):
+        raise ValueError("Cursor does not belong to the sort order %s" % signature)
+    return direction, values
+
+
+def _encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return {"datetime": value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {"date": value.isoformat()}
+    if isinstance(value, decimal.Decimal):
+        return {"decimal": str(value)}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        if "datetime" in value:
+            return datetime.datetime.fromisoformat(value["datetime"])
+        if "date" in value:
+            return datetime.date.fromisoformat(value["date"])
+        if "decimal" in value:
+            return decimal.Decimal(value["decimal"])
+        raise ValueError("Unknown cursor value %s" % value)
+    return value
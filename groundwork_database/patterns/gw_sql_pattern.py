@@ -1,14 +1,38 @@
+import itertools
 import logging
+import threading
+import time
+from concurrent.futures import Future
 
-from sqlalchemy import create_engine
+from sqlalchemy import Table, inspect
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import scoped_session, sessionmaker
-from sqlalchemy.orm.attributes import InstrumentedAttribute
-
-from groundwork.docstring import parse
+from sqlalchemy.orm import Query, scoped_session, sessionmaker
 
 from groundwork.patterns import GwBasePattern
 
+from groundwork_database.patterns import gw_sql_bulk
+from groundwork_database.patterns.gw_sql_buffer import WriteBuffer
+from groundwork_database.patterns.gw_sql_cache import ResultCache
+from groundwork_database.patterns.gw_sql_changes import ChangeFeed
+from groundwork_database.patterns.gw_sql_explain import ExplainCapture
+from groundwork_database.patterns.gw_sql_fanout import FanOut, get_fan_out_function
+from groundwork_database.patterns.gw_sql_fetch import fetch_arrays, fetch_rows, get_select
+from groundwork_database.patterns.gw_sql_identity import IDENTITY_CACHE_KEY, CachingQuery, CachingSession, IdentityCache
+from groundwork_database.patterns.gw_sql_indexes import IndexManager
+from groundwork_database.patterns.gw_sql_instrumentation import get_query_statistics, sort_statements, summarize
+from groundwork_database.patterns.gw_sql_introspection import get_class_metadata
+from groundwork_database.patterns.gw_sql_nplusone import NPlusOneDetector
+from groundwork_database.patterns.gw_sql_pagination import paginate
+from groundwork_database.patterns.gw_sql_pool import (EngineRegistry, acquire_engine, get_engine_options,
+                                                      is_thread_bound, release_engine)
+from groundwork_database.patterns.gw_sql_replicas import ROUTER_KEY, Replica, ReplicaRouter, RoutingSession, has_writes
+from groundwork_database.patterns.gw_sql_schema import create_schema
+from groundwork_database.patterns.gw_sql_sqlite import get_sqlite_pragmas, is_sqlite
+from groundwork_database.patterns.gw_sql_utils import (SessionTracker, count_rows, expunge_chunk, get_database_size,
+                                                       get_table)
+from groundwork_database.patterns.gw_sql_writer import WriteScheduler
+
 
 class GwSqlPattern(GwBasePattern):
     """
@@ -43,22 +67,64 @@ class SqlDatabasesPlugin:
 
     def __deactivate_sql_databases(self, plugin, *args, **kwargs):
         databases = self.get()
-        for databases in databases.keys():
-            self.unregister(databases)
+        for database in list(databases.keys()):
+            report = self.unregister(database)
+            # Teardowns scheduled on a running event loop do not report open connections yet
+            if report is not None and report.get("connections_open", 0) > 0:
+                self.log.warning("Database %s still has %s open connections after deactivation"
+                                 % (database, report["connections_open"]))
 
-    def register(self, database, database_url, description):
+    def register(self, database, database_url, description, **kwargs):
         """
         Registers a new sql database for a plugin.
+
+        Additional keyword arguments are passed to :class:`~.Database`, e.g.::
+
+            self.databases.register("my_db", "sqlite:///my.db", "My database", lazy=True,
+                                    pool_class="QueuePool", pool_size=5, max_overflow=10, pool_pre_ping=True)
+
+        A list or dict of urls registers a :class:`~.ShardedDatabase`, which spreads its rows over all of them::
+
+            self.databases.register("my_db", ["sqlite:///my_0.db", "sqlite:///my_1.db"], "My database",
+                                    shard_key=lambda clazz, identity: identity[0])
+
+        :param database: name of the database
+        :param database_url: SQLAlchemy database url or list or dict of urls of shards
+        :param description: description of the database
         """
-        return self.app.databases.register(database, database_url, description, self.plugin)
+        return self.app.databases.register(database, database_url, description, self.plugin, **kwargs)
+
+    def register_async(self, database, database_url, description, **kwargs):
+        """
+        Registers a new sql database with an asyncio engine for a plugin.
+        The database_url must use an async driver, e.g. ``sqlite+aiosqlite:///my.db``.
+
+        Additional keyword arguments are passed to :class:`~.AsyncDatabase`.
+
+        :param database: name of the database
+        :param database_url: SQLAlchemy database url
+        :param description: description of the database
+        """
+        return self.app.databases.register_async(database, database_url, description, self.plugin, **kwargs)
 
     def unregister(self, database):
         """
         Unregisters an existing database, so that this database is no longer.
         This function is mainly used during plugin deactivation.
+
+        :return: dict, which reports the released resources. See :func:`Database.dispose`.
         """
         return self.app.databases.unregister(database)
 
+    async def unregister_async(self, database):
+        """
+        Unregisters an existing database from inside a coroutine.
+        Needed for databases registered by :func:`register_async`, to await the complete teardown.
+
+        :return: dict, which reports the released resources. See :func:`Database.dispose`.
+        """
+        return await self.app.databases.unregister_async(database)
+
     def get(self, name=None):
         """
         Returns databases, which can be filtered by name.
@@ -75,6 +141,14 @@ class SqlDatabasesApplication:
         self.app = app
         self.log = logging.getLogger(__name__)
         self._databases = {}
+
+        #: Instance of :class:`~.EngineRegistry`.
+        #: Shares engines between databases with equal url and engine options.
+        self.engines = EngineRegistry()
+
+        #: Instance of :class:`~.FanOut`.
+        #: Runs functions and statements for several databases at the same time, see :func:`fan_out`.
+        self.fan_out_pool = FanOut(self.app.config.get("DATABASE_FAN_OUT_WORKERS", 8))
         self.log.info("Application sql databases initialised")
 
         self.app.signals.register("db_registered", self.app,
@@ -85,18 +159,44 @@ class SqlDatabasesApplication:
                                   "Fired if a new database class was registered by a plugin "
                                   "Provided arguments are: database, db_class and plugin")
 
-    def register(self, database, database_url, description, plugin=None):
+        self.app.signals.register("db_changes", self.app,
+                                  "Fired after a commit, which has inserted, updated or deleted objects of "
+                                  "registered classes of a database with change feed. "
+                                  "Provided arguments are: database, changes and plugin")
+
+    def register(self, database, database_url, description, plugin=None, **kwargs):
         """
         Registers a new sql database for a plugin.
+        Additional keyword arguments are passed to :class:`~.Database`.
+        If database_url is a list or dict of urls, a :class:`~.ShardedDatabase` gets registered.
+        """
+        kwargs.setdefault("engine_registry", self.engines)
+        if isinstance(database_url, (list, tuple, dict)):
+            # The sharding module needs DatabaseClass of this module, so it gets imported on first usage only.
+            from groundwork_database.patterns.gw_sql_sharding import ShardedDatabase
+
+            return self._add(ShardedDatabase, database, database_url, description, plugin, **kwargs)
+        return self._add(Database, database, database_url, description, plugin, **kwargs)
+
+    def register_async(self, database, database_url, description, plugin=None, **kwargs):
         """
+        Registers a new sql database with an asyncio engine for a plugin.
+        Additional keyword arguments are passed to :class:`~.AsyncDatabase`.
+        """
+        # asyncio support of sqlalchemy is optional, so it gets imported on first usage only.
+        from groundwork_database.patterns.gw_sql_async import AsyncDatabase
+
+        return self._add(AsyncDatabase, database, database_url, description, plugin, **kwargs)
+
+    def _add(self, database_class, database, database_url, description, plugin, **kwargs):
         if database in self._databases.keys():
             raise DatabaseExistException("Database %s already registered by %s" % (
                 database, self._databases[database].plugin.name))
 
         if plugin is None:
-            new_database = Database(database, database_url, description, app=self.app)
+            new_database = database_class(database, database_url, description, app=self.app, **kwargs)
         else:
-            new_database = Database(database, database_url, description, plugin=plugin)
+            new_database = database_class(database, database_url, description, plugin=plugin, **kwargs)
 
         self._databases[database] = new_database
         self.log.debug("Database registered: %s" % database)
@@ -111,12 +211,122 @@ class SqlDatabasesApplication:
         """
         Unregisters an existing database, so that this database is no longer.
         This function is mainly used during plugin deactivation.
+
+        Sessions, connections and engine of the database get released, see :func:`Database.dispose`.
+
+        :return: dict, which reports the released resources. None, if the database does not exist.
         """
         if database not in self._databases.keys():
             self.log.warning("Can not unregister database %s. Reason: Database does not exist." % database)
+            return None
+        report = self._databases[database].dispose()
+        del (self._databases[database])
+        self.log.debug("Database %s got unregistered" % database)
+        return report
+
+    async def unregister_async(self, database):
+        """
+        Unregisters an existing database from inside a coroutine.
+        Databases with an asyncio engine get disposed completely before this function returns.
+
+        :return: dict, which reports the released resources. None, if the database does not exist.
+        """
+        if database not in self._databases.keys():
+            self.log.warning("Can not unregister database %s. Reason: Database does not exist." % database)
+            return None
+        db = self._databases.pop(database)
+        if hasattr(db, "dispose_async"):
+            report = await db.dispose_async()
+        else:
+            report = db.dispose()
+        self.log.debug("Database %s got unregistered" % database)
+        return report
+
+    def fan_out(self, function_or_statement, databases=None, timeout=None, named=False):
+        """
+        Runs a function or select statement for several databases at the same time on a bounded thread pool.
+        The number of threads is set by the config key ``DATABASE_FAN_OUT_WORKERS`` (default 8)::
+
+            result = app.databases.fan_out("SELECT name FROM users WHERE name LIKE 'a%'", timeout=2)
+            names = result.merge(key=lambda row: row[0])
+            for name, error in result.errors.items():
+                print("%s failed: %s" % (name, error))
+
+            health = app.databases.fan_out(lambda db: db.fetch(text("SELECT 1")), timeout=0.5)
+            down = health.failed
+
+        Failures and timeouts of single databases do not cancel the other ones, but get reported by the result.
+        See :class:`~.FanOut`.
+
+        :param function_or_statement: function, which gets the :class:`~.Database` and returns its result, or
+                                      anything :func:`Database.fetch` accepts. Strings are executed as textual SQL.
+        :param databases: list of database names. Default are all registered databases.
+        :param timeout: Seconds each database has to answer, or dict of database name and seconds
+        :param named: If True, rows of statements support access by column name
+        :return: :class:`~.FanOutResult`
+        """
+        if databases is None:
+            selected = dict(self._databases)
         else:
-            del (self._databases[database])
-            self.log.debug("Database %s git unregistered" % database)
+            unknown = [name for name in databases if name not in self._databases.keys()]
+            if unknown:
+                raise ValueError("Unknown databases: %s" % ", ".join(unknown))
+            selected = dict((name, self._databases[name]) for name in databases)
+        return self.fan_out_pool.run(selected, get_fan_out_function(function_or_statement, named), timeout)
+
+    def query_stats(self, order_by="total_time", limit=None):
+        """
+        Returns the execution statistics of the statements of all instrumented databases, sorted descending.
+        Each statement contains the name of its database. See :func:`Database.query_stats`.
+
+        Databases sharing an engine also share their statistics. They get reported once,
+        by the first registered database.
+
+        :param order_by: key to sort by, e.g. "total_time", "count", "max_time", "p99" or "rows"
+        :param limit: maximum number of statements to return
+        :return: list of dicts
+        """
+        statements = []
+        for name, database in self._get_instrumented_databases():
+            for statement in database.query_stats():
+                statement["database"] = name
+                statements.append(statement)
+        return sort_statements(statements, order_by, limit)
+
+    def slow_queries(self):
+        """
+        Returns the slow query logs of all databases, oldest first. Each entry contains the name of its database.
+        Databases sharing an engine get reported once, see :func:`query_stats`.
+        """
+        queries = []
+        for name, database in self._get_instrumented_databases():
+            for query in database.slow_queries():
+                query["database"] = name
+                queries.append(query)
+        queries.sort(key=lambda query: query["time"])
+        return queries
+
+    def _get_instrumented_databases(self):
+        # Skips databases, whose statistics were already returned for another database with the same engines
+        seen = set()
+        for name, database in self._databases.items():
+            statistics = [statistics for statistics in database.get_query_statistics() if statistics not in seen]
+            if statistics:
+                seen.update(statistics)
+                yield name, database
+
+    def stats(self, name=None):
+        """
+        Returns the usage overview of all databases or of a single one. See :func:`Database.stats`.
+
+        :param name: name of the database
+        :return: dict of database name and its statistics
+        """
+        stats = {}
+        for key, database in self._databases.items():
+            if name is None or key == name:
+                stats[key] = database.stats()
+        return stats
 
     def get(self, name=None, plugin=None):
         """
@@ -152,37 +362,580 @@ class SqlDatabasesApplication:
 
 
 class Database:
-    def __init__(self, name, url, description, plugin=None, app=None):
+    """
+    A sql database, registered by a plugin or the application.
+
+    :param name: name of the database
+    :param url: SQLAlchemy database url
+    :param description: description of the database
+    :param plugin: plugin, which has registered the database
+    :param app: application, if the database was not registered by a plugin
+    :param lazy: If True, engine and session get created on first usage and not during registration
+    :param pool_class: Pool class or name of a pool class from ``sqlalchemy.pool``, e.g. "QueuePool"
+    :param pool_size: Number of connections to keep open inside the pool
+    :param max_overflow: Number of connections, which can be opened additionally to pool_size
+    :param pool_timeout: Seconds to wait for a free connection, before an error gets raised
+    :param pool_recycle: Seconds after which a connection gets recycled
+    :param pool_pre_ping: If True, connections get tested for liveness on checkout
+    :param engine_registry: :class:`~.EngineRegistry` to share the engine with other databases.
+                            If None, the database creates its own engine.
+    :param replica_urls: List of urls of read replicas. Selects of the session get routed to them.
+    :param replica_policy: "round_robin", "least_checked_out" or a callable, which gets a list of
+                           :class:`~.Replica` objects and returns the one to use.
+    :param replica_pin_time: Seconds, for which reads of a thread go to the primary after it has committed writes.
+    :param instrument: If True, execution statistics get collected per statement, see :func:`query_stats`.
+    :param slow_query_threshold: Seconds, after which a statement gets stored in the slow query log.
+                                 Enables instrumentation.
+    :param cache_results: If True, results of selects executed by the session get cached, see :class:`~.ResultCache`.
+    :param cache_max_entries: Maximum number of cached results
+    :param cache_max_bytes: Maximum estimated memory of all cached results
+    :param cache_ttl: Seconds after which a cached result expires
+    :param identity_cache_size: Maximum number of objects inside the identity cache, see :class:`~.IdentityCache`.
+                                Classes get cached, if registered with ``identity_cache=True``.
+    :param identity_cache_ttl: Seconds after which an object inside the identity cache expires
+    :param sqlite_profile: Name of a SQLite performance profile ("durable", "fast-write" or "read-heavy", see
+                           :data:`~.SQLITE_PROFILES`) or a dict of PRAGMAs, which get set on every new connection.
+                           Only for SQLite urls.
+    :param serialize_writes: If True, commits of :func:`commit` and jobs of :func:`write` get executed one after
+                             another by a single writer thread, see :class:`~.WriteScheduler`.
+                             Avoids lock contention of several writing threads, e.g. on SQLite.
+                             Sessions must not flush themselves then, the writer flushes their changes on commit.
+                             Not available for in-memory SQLite databases or engines with a SingletonThreadPool or
+                             StaticPool.
+    :param write_batch_size: Maximum number of write jobs, which get merged into one transaction
+    :param write_batch_delay: Seconds the writer waits for further jobs, before it commits a group
+    :param write_buffer_size: Number of entries of :attr:`write_buffer`, which trigger a flush
+    :param write_buffer_interval: Maximum seconds an entry stays inside :attr:`write_buffer`
+    :param write_buffer_max_pending: Maximum number of entries inside :attr:`write_buffer`, before adding blocks
+    :param n_plus_one_threshold: Number of equal selects of a session inside one transaction, after which N+1 queries
+                                 get reported, see :class:`~.NPlusOneDetector`. None disables the detection.
+    :param n_plus_one_raise: If True, detected N+1 queries raise an exception instead of logging a warning
+    :param explain_threshold: Seconds, after which the plan of a statement gets captured by EXPLAIN and checked for
+                              full scans of tables of registered classes, see :class:`~.ExplainCapture`.
+                              None disables capturing.
+    :param change_feed: If True, primary keys of inserted, updated and deleted objects of registered classes get
+                        published after each commit by the signal ``db_changes`` and to the subscriptions of
+                        :attr:`change_feed`, see :class:`~.ChangeFeed`.
+    """
+
+    def __init__(self, name, url, description, plugin=None, app=None, lazy=False, pool_class=None, pool_size=None,
+                 max_overflow=None, pool_timeout=None, pool_recycle=None, pool_pre_ping=None, engine_registry=None,
+                 replica_urls=None, replica_policy="round_robin", replica_pin_time=1.0, instrument=False,
+                 slow_query_threshold=None, cache_results=False, cache_max_entries=1000,
+                 cache_max_bytes=64 * 1024 * 1024, cache_ttl=300, identity_cache_size=10000,
+                 identity_cache_ttl=300, sqlite_profile=None, serialize_writes=False, write_batch_size=100,
+                 write_batch_delay=0.0, write_buffer_size=1000, write_buffer_interval=1.0,
+                 write_buffer_max_pending=10000, n_plus_one_threshold=None, n_plus_one_raise=False,
+                 explain_threshold=None, change_feed=False):
         self.name = name
         self.database_url = url
         self.description = description
         self.plugin = plugin
         self.app = app
+        self.lazy = lazy
+
+        #: Keyword arguments for create_engine
+        self.engine_options = get_engine_options(pool_class, pool_size, max_overflow, pool_timeout, pool_recycle,
+                                                 pool_pre_ping)
+        self._pool_statistics = None
+        self._engine_registry = engine_registry
+
+        #: PRAGMAs of the SQLite profile, which get executed on every new connection
+        self.sqlite_pragmas = get_sqlite_pragmas(sqlite_profile)
+        if self.sqlite_pragmas and not all(is_sqlite(url) for url in [url] + list(replica_urls or [])):
+            raise ValueError("SQLite profiles can only be used for SQLite databases")
+        self.sqlite_profile = sqlite_profile
+
+        self.replica_urls = list(replica_urls or [])
+        self.replica_policy = replica_policy
+        self.replica_pin_time = replica_pin_time
+        #: Instance of :class:`~.ReplicaRouter`, if the database has replicas.
+        self.router = None
+
+        self.instrument = instrument or slow_query_threshold is not None
+        self.slow_query_threshold = slow_query_threshold
+        #: Instance of :class:`~.QueryStatistics`, if instrumentation is enabled and the engine is created.
+        #: Databases sharing an engine also share these statistics.
+        self.query_statistics = None
+
+        #: Instance of :class:`~.ResultCache`, if caching of results is enabled.
+        self.result_cache = None
+        if cache_results:
+            self.result_cache = ResultCache(cache_max_entries, cache_max_bytes, cache_ttl)
+        #: Instance of :class:`~.IdentityCache` for primary key lookups of registered classes.
+        self.identity_cache = IdentityCache(identity_cache_size, identity_cache_ttl)
+        self._session_factory = None
+
+        if serialize_writes and is_thread_bound(url, self.engine_options.get("poolclass")):
+            # The writer thread would commit into its own, empty database
+            raise ValueError("serialize_writes can not be used for in-memory SQLite databases or engines with a "
+                             "SingletonThreadPool or StaticPool, as their connections are bound to threads")
+        self.serialize_writes = serialize_writes
+        self.write_batch_size = write_batch_size
+        self.write_batch_delay = write_batch_delay
+        #: Instance of :class:`~.WriteScheduler`, if writes get serialized and the session is created.
+        self.writer = None
+
+        #: Instance of :class:`~.NPlusOneDetector`, if the detection of N+1 queries is enabled.
+        self.n_plus_one_detector = None
+        if n_plus_one_threshold is not None:
+            self.n_plus_one_detector = NPlusOneDetector(n_plus_one_threshold, n_plus_one_raise)
+
+        self.explain_threshold = explain_threshold
+        #: Instance of :class:`~.ExplainCapture`, if capturing of plans is enabled and the engine is created.
+        self.explain_capture = None
+
+        #: Instance of :class:`~.ChangeFeed`, if the change feed is enabled.
+        self.change_feed = None
+        if change_feed:
+            self.change_feed = ChangeFeed(self._get_class_names, self._publish_changes, name)
 
-        self.engine = create_engine(url)
+        #: Instance of :class:`~.IndexManager` for the indexes declared by registered classes
+        self.indexes = IndexManager()
+
+        #: Instance of :class:`~.WriteBuffer` to write objects and rows in bulk by a background thread
+        self.write_buffer = WriteBuffer(self, write_buffer_size, write_buffer_interval, write_buffer_max_pending)
+
+        #: Seconds needed to create engine and session. None, as long as they are not created.
+        self.build_time = None
+
+        self._engine = None
+        self._session = None
+        self._query_property = None
+        self._build_lock = threading.Lock()
+        self._sessions = SessionTracker()
 
-        self.session = scoped_session(sessionmaker(autocommit=False,
-                                                   autoflush=False,
-                                                   bind=self.engine))
         self.Base = declarative_base()
 
         # This allows to perform Class.query (e.g. User.query), which is normally not
         # available on pure sqlalchemy models. But this kind of usage is provided by libs like flask-sqlalachemy,
         # what makes it very handy to query classes.
         # Fore more visit: http://stackoverflow.com/a/28025843
-        self.Base.query = self.session.query_property()
+        # The query property gets created together with the session, so Base.query does not trigger the
+        # engine creation before it is really used.
+        self.Base.query = _LazyQueryProperty(self)
 
         self.classes = DatabaseClass(self, self.plugin, self.app)
 
-    def create_all(self):
-        return self.Base.metadata.create_all(self.engine)
+        if not self.lazy:
+            self._build()
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            self._build()
+        return self._engine
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._build()
+        return self._session
+
+    @property
+    def is_built(self):
+        """
+        True, if engine and session are already created.
+        """
+        return self._session is not None
+
+    def _build(self):
+        with self._build_lock:
+            if self._session is not None:
+                return
+            start = time.time()
+            engine, self._pool_statistics = self._acquire_engine(self.database_url)
+            self._engine = engine
+            if self.instrument:
+                self.query_statistics = get_query_statistics(engine, self.slow_query_threshold)
+            if self.explain_threshold is not None:
+                self.explain_capture = ExplainCapture(engine, self.explain_threshold, self._get_class_tables)
+                self.explain_capture.attach()
+            session_class = CachingSession
+            session_info = {IDENTITY_CACHE_KEY: self.identity_cache}
+            if self.replica_urls:
+                replicas = [Replica(url, *self._acquire_engine(url)) for url in self.replica_urls]
+                if self.instrument:
+                    for replica in replicas:
+                        get_query_statistics(replica.engine, self.slow_query_threshold)
+                self.router = ReplicaRouter(engine, replicas, self.replica_policy, self.replica_pin_time)
+                session_class = RoutingSession
+                session_info[ROUTER_KEY] = self.router
+            session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine, class_=session_class,
+                                           query_cls=CachingQuery, info=session_info)
+            self._sessions.attach(session_factory)
+            # Before the caches, so that selects answered by a cache get counted as well
+            if self.n_plus_one_detector is not None:
+                self.n_plus_one_detector.attach(session_factory)
+            if self.result_cache is not None:
+                self.result_cache.attach(engine, session_factory)
+            self.identity_cache.attach(session_factory)
+            if self.change_feed is not None:
+                self.change_feed.attach(session_factory)
+            if self.serialize_writes:
+                self.writer = WriteScheduler(session_factory, self.write_batch_size, self.write_batch_delay)
+                self.writer.attach(session_factory)
+            self._session_factory = session_factory
+            self._session = scoped_session(session_factory)
+            self._query_property = self._session.query_property()
+            self.build_time = time.time() - start
+            logging.getLogger(__name__).debug("Engine and session of database %s created in %.4fs"
+                                              % (self.name, self.build_time))
+
+    def _acquire_engine(self, url):
+        return acquire_engine(url, self.engine_options, self.sqlite_pragmas, self._engine_registry)
+
+    def dispose(self):
+        """
+        Closes the sessions of all threads, so that their connections get returned to the pool,
+        and releases the engine of the database.
+        A shared engine gets only disposed, if no other database uses it.
+        Engine and session get created again on next usage.
+
+        Sessions get closed from the calling thread, so they should not be in use anymore.
+        Subscriptions of the change feed get closed.
+
+        The returned report contains:
+
+        * buffer_flushed: number of entries of the write buffer, which got written
+        * sessions_closed: number of closed sessions
+        * connections_closed: number of closed database connections
+        * connections_open: number of connections, which are still checked out from the engine
+        * engine_disposed: True, if the engine got disposed
+
+        :return: dict, which reports the released resources
+        """
+        report = {
+            "database": self.name,
+            "buffer_flushed": 0,
+            "sessions_closed": 0,
+            "connections_closed": 0,
+            "connections_open": 0,
+            "engine_disposed": False,
+        }
+        try:
+            report["buffer_flushed"] = self.write_buffer.stop()
+        except Exception:
+            logging.getLogger(__name__).exception("Write buffer of database %s could not be flushed" % self.name)
+
+        with self._build_lock:
+            engine = self._engine
+            if engine is None:
+                return report
+            statistics = self._pool_statistics
+            closes = statistics.closes
+
+            self.indexes.join()
+
+            # Queued writes get executed, before the sessions get closed
+            if self.writer is not None:
+                self.writer.stop()
+                self.writer = None
+
+            sessions = self._sessions.pop_all()
+            for session in sessions:
+                session.close()
+            report["sessions_closed"] = len(sessions)
+            self._session.remove()
+
+            if self.result_cache is not None:
+                self.result_cache.detach(engine, self._session_factory)
+                self.result_cache.clear()
+            self.identity_cache.clear()
+            if self.explain_capture is not None:
+                self.explain_capture.detach()
+                self.explain_capture = None
+            if self.change_feed is not None:
+                self.change_feed.close()
+            if self.router is not None:
+                for replica in self.router.replicas:
+                    release_engine(replica.engine, self._engine_registry)
+
+            self._engine = None
+            self._session = None
+            self._query_property = None
+            self._pool_statistics = None
+            self.query_statistics = None
+            self.router = None
+            self._session_factory = None
+            report["engine_disposed"] = release_engine(engine, self._engine_registry)
+
+            report["connections_closed"] = statistics.closes - closes
+            report["connections_open"] = statistics.to_dict()["checked_out"]
+
+        logging.getLogger(__name__).debug("Database %s disposed: %s" % (self.name, report))
+        return report
+
+    def pool_stats(self):
+        """
+        Returns live statistics of the connection pool, like checked out connections, overflow,
+        wait time and checkout latency.
+        Returns None, if the engine of a lazy database was not created yet.
+        Statistics of replicas are stored as list under "replicas".
+
+        :return: dict of statistics or None
+        """
+        if self._pool_statistics is None:
+            return None
+        stats = self._pool_statistics.to_dict()
+        if self.router is not None:
+            stats["replicas"] = [replica.statistics.to_dict() for replica in self.router.replicas]
+        return stats
+
+    def cache_stats(self):
+        """
+        Returns the counters of the result cache: entries, bytes, hits, misses, hit_ratio, evictions,
+        expirations and invalidations.
+        Returns None, if caching of results is not enabled.
+
+        :return: dict or None
+        """
+        if self.result_cache is None:
+            return None
+        return self.result_cache.to_dict()
+
+    def identity_cache_stats(self):
+        """
+        Returns the counters of the identity cache: entries, hits, misses, hit_ratio, evictions and invalidations.
+
+        :return: dict
+        """
+        return self.identity_cache.to_dict()
+
+    def n_plus_one_report(self):
+        """
+        Returns the detected N+1 queries, each one as dict with model, relationship, statement, count and time.
+        Returns None, if the detection is not enabled.
+
+        :return: list of dicts or None
+        """
+        if self.n_plus_one_detector is None:
+            return None
+        return self.n_plus_one_detector.detections()
+
+    def explain_report(self):
+        """
+        Returns the plans of slow statements, slowest first. Each one is a dict with fingerprint, statement,
+        duration, time, plan, full_scans (tables of registered classes) and suggested_indexes.
+        Returns None, if capturing of plans is not enabled or the engine is not created yet.
+
+        :return: list of dicts or None
+        """
+        if self.explain_capture is None:
+            return None
+        return self.explain_capture.plans()
+
+    def index_report(self):
+        """
+        Returns the indexes declared by registered classes with their build status, see :func:`~.IndexManager.status`.
+
+        :return: list of dicts
+        """
+        return self.indexes.status()
+
+    def unused_indexes(self):
+        """
+        Returns the declared indexes, whose leading column is not used by any statement of the query log.
+        Returns None, if instrumentation is not enabled.
+
+        :return: list of dicts or None
+        """
+        if not self.instrument:
+            return None
+        return self.indexes.unused([statement["statement"] for statement in self.query_stats()])
+
+    def _get_class_names(self):
+        return dict((model.clazz, name) for name, model in self.classes.get().items())
+
+    def _publish_changes(self, changes):
+        if self.plugin is not None:
+            self.plugin.signals.send("db_changes", database=self, changes=changes)
+        elif self.app is not None:
+            self.app.signals.send("db_changes", database=self, changes=changes, plugin=self.app)
+
+    def _get_class_tables(self):
+        tables = set()
+        for model in self.classes.get().values():
+            table = getattr(model.clazz, "__table__", None)
+            if table is not None:
+                tables.add(table.name)
+        return tables
+
+    def query_stats(self, order_by="total_time", limit=None):
+        """
+        Returns execution statistics per normalized statement: count, total/avg/max time,
+        latency percentiles p50/p95/p99, rows and a fingerprint of the normalized statement.
+        Statements executed on replicas are part of the result.
+
+        Returns an empty list, if instrumentation is not enabled or the engine was not created yet.
+
+        :param order_by: key to sort by (descending), e.g. "total_time", "count", "max_time", "p99" or "rows"
+        :param limit: maximum number of statements to return
+        :return: list of dicts
+        """
+        statements = []
+        for statistics in self.get_query_statistics():
+            statements.extend(statistics.statements())
+        return sort_statements(statements, order_by, limit)
+
+    def slow_queries(self):
+        """
+        Returns the slow query log, oldest first. Each entry contains fingerprint, statement, duration and time.
+        """
+        queries = []
+        for statistics in self.get_query_statistics():
+            queries.extend(statistics.slow_queries())
+        queries.sort(key=lambda query: query["time"])
+        return queries
+
+    def stats(self, slowest=5):
+        """
+        Returns an overview of the database usage:
+
+        * url: database url without password
+        * built: True, if engine and session are created
+        * build_time: seconds needed to create engine and session
+        * classes: number of registered database classes
+        * pool: pool statistics, see :func:`pool_stats`
+        * statements: count, total_time and percentiles p50/p95/p99 of all statements. None, if not instrumented.
+        * slowest_statements: statements with the highest max_time, see :func:`query_stats`
+        * tables: dict of table name and dict with rows and estimated (True, if rows is an estimation)
+        * size: size in bytes of file based databases, otherwise None
+        * writer: statistics of the writer thread, see :func:`writer_stats`
+        * write_buffer: statistics of the write buffer, see :class:`~.WriteBuffer`
+        * change_feed: published change sets, subscriptions and dropped change sets. None, if not enabled.
+
+        Tables and pool are only inspected, if the engine is already created.
+
+        :param slowest: Number of slowest statements to return
+        :return: dict
+        """
+        stats = {
+            "name": self.name,
+            "description": self.description,
+            "url": make_url(self.database_url).render_as_string(hide_password=True),
+            "built": self.is_built,
+            "build_time": self.build_time,
+            "classes": len(self.classes.get()),
+            "pool": self.pool_stats(),
+            "statements": summarize(self.get_query_statistics()) if self.query_statistics is not None else None,
+            "slowest_statements": self.query_stats(order_by="max_time", limit=slowest),
+            "tables": {},
+            "size": get_database_size(self.database_url),
+            "writer": self.writer_stats(),
+            "write_buffer": self.write_buffer.to_dict(),
+            "change_feed": self.change_feed.to_dict() if self.change_feed is not None else None,
+        }
+        if self.is_built:
+            inspector = inspect(self.engine)
+            for table in self.Base.metadata.sorted_tables:
+                if inspector.has_table(table.name, schema=table.schema):
+                    rows, estimated = count_rows(self.engine, table)
+                    stats["tables"][table.name] = {"rows": rows, "estimated": estimated}
+        return stats
+
+    def get_query_statistics(self):
+        """
+        Returns the :class:`~.QueryStatistics` of the engine and of all replicas.
+        Empty, if instrumentation is not enabled or the engine was not created yet.
+        """
+        if self.query_statistics is None:
+            return []
+        statistics = [self.query_statistics]
+        if self.router is not None:
+            statistics.extend(get_query_statistics(replica.engine) for replica in self.router.replicas)
+        return statistics
+
+    def create_all(self, force=False):
+        """
+        Creates missing tables and indexes of all classes.
+        Indexes declared by ``classes.register(..., indexes=[...])`` get created afterwards by a background thread,
+        see :class:`~.IndexManager`.
+
+        Skips all checks against the database, if the schema has not changed since the last call,
+        see :func:`~.create_schema`.
+
+        :param force: If True, the database gets checked for missing tables and indexes in any case
+        :return: dict with fingerprint, skipped, created_tables and created_indexes
+        """
+        with self.engine.begin() as connection:
+            report = create_schema(connection, self.Base.metadata, self.name, force)
+        # Declared indexes get created in the background, so that they do not block the startup
+        if self.indexes.status():
+            self.indexes.ensure(self.engine)
+        return report
 
     def commit(self, *args, **kwargs):
-        return self.session.commit(*args, **kwargs)
+        session = self.session()
+        writer = self.writer
+        if writer is None or writer.is_writer_thread:
+            return session.commit(*args, **kwargs)
+        wrote = self.router is not None and has_writes(session)
+        result = writer.submit_commit(session).result()
+        # The commit pins the writer thread, but the committing thread must read its own writes
+        if wrote:
+            self.router.pin()
+        return result
+
+    def write(self, function, *args, **kwargs):
+        """
+        Executes a write job inside a new session and commits it.
+        With ``serialize_writes=True`` the job gets executed by the writer thread together with other
+        queued jobs, see :class:`~.WriteScheduler`. Returned objects are detached from the session.
+
+        :param function: function, which gets a session followed by args and kwargs. It must not commit.
+        :return: return value of the function
+        """
+        return self.submit_write(function, *args, **kwargs).result()
+
+    def submit_write(self, function, *args, **kwargs):
+        """
+        Like :func:`write`, but returns a ``concurrent.futures.Future`` instead of waiting for the result.
+        Without ``serialize_writes=True`` the job gets executed immediately.
+        """
+        if not self.is_built:
+            self._build()
+        writer = self.writer
+        if writer is not None and not writer.is_writer_thread:
+            return writer.submit(function, *args, **kwargs)
+
+        future = Future()
+        session = self._session_factory(expire_on_commit=False)
+        try:
+            result = function(session, *args, **kwargs)
+            session.commit()
+            future.set_result(result)
+        except Exception as e:
+            session.rollback()
+            future.set_exception(e)
+        finally:
+            session.close()
+        return future
+
+    def writer_stats(self):
+        """
+        Returns queue depth, number of commits and batch sizes of the writer thread.
+        Returns None, if writes do not get serialized or the session is not created yet.
+
+        :return: dict or None
+        """
+        if self.writer is None:
+            return None
+        return self.writer.to_dict()
 
     def query(self, *args, **kwargs):
         return self.session.query(*args, **kwargs)
 
+    def get(self, model, ident):
+        """
+        Returns the object of a class by its primary key or None.
+        Uses the identity cache, if the class was registered with ``identity_cache=True``.
+
+        :param model: mapped class or :class:`~.DatabaseModel`
+        :param ident: primary key value or tuple of values for composite primary keys
+        """
+        return self.session.get(getattr(model, "clazz", model), ident)
+
     def add(self, *args, **kwargs):
         return self.session.add(*args, **kwargs)
 
@@ -195,6 +948,138 @@ class Database:
     def close(self, *args, **kwargs):
         return self.session.close(*args, **kwargs)
 
+    def stream(self, query_or_model, chunk_size=1000):
+        """
+        Yields the results of a query in lists of up to chunk_size rows or objects.
+
+        Rows get fetched by a server-side cursor, if the database supports it, otherwise by ``yield_per``.
+        Objects of a chunk get expunged from the session, as soon as the next chunk is requested.
+        So memory usage stays flat, independent of the number of results::
+
+            for users in db.stream(User, chunk_size=500):
+                for user in users:
+                    print(user.name)
+
+        :param query_or_model: query, sqlalchemy table, mapped class or :class:`~.DatabaseModel`
+        :param chunk_size: Number of rows or objects per chunk
+        :return: generator of lists
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+
+        if isinstance(query_or_model, Query):
+            query = query_or_model
+        elif isinstance(query_or_model, Table):
+            query = self.session.query(query_or_model)
+        else:
+            query = self.session.query(getattr(query_or_model, "clazz", query_or_model))
+
+        query = query.yield_per(chunk_size)
+        if self.engine.dialect.supports_server_side_cursors:
+            query = query.execution_options(stream_results=True)
+
+        session = query.session
+        results = iter(query)
+        try:
+            while True:
+                chunk = list(itertools.islice(results, chunk_size))
+                if not chunk:
+                    break
+                yield chunk
+                expunge_chunk(session, chunk)
+        finally:
+            close = getattr(results, "close", None)
+            if close is not None:
+                close()
+
+    def fetch(self, query_or_model, columns=None, named=False):
+        """
+        Returns the rows of a select as tuples, without creating ORM objects and without using the session.
+        Reads get routed to a replica, if the database has some::
+
+            for name, fullname in db.fetch(User, columns=["name", "fullname"]):
+                print(name, fullname)
+
+        :param query_or_model: select statement, query, sqlalchemy table, mapped class or :class:`~.DatabaseModel`
+        :param columns: names of the columns to select from a table or model. Default are all columns.
+        :param named: If True, rows support access by column name (``row.name``)
+        :return: list of rows
+        """
+        statement = get_select(query_or_model, columns)
+        with self._get_read_engine().connect() as connection:
+            return fetch_rows(connection, statement, named)
+
+    def fetch_arrays(self, query_or_model, columns=None, chunk_size=10000, dtypes=None):
+        """
+        Returns the values of each selected column as NumPy array. Needs NumPy.
+        Rows get fetched and converted in chunks, see :func:`~.gw_sql_fetch.fetch_arrays`::
+
+            arrays = db.fetch_arrays(Measurement, columns=["value"], dtypes={"value": "float64"})
+            mean = arrays["value"].mean()
+
+        :param query_or_model: select statement, query, sqlalchemy table, mapped class or :class:`~.DatabaseModel`
+        :param columns: names of the columns to select from a table or model. Default are all columns.
+        :param chunk_size: Number of rows, which get fetched and converted at once
+        :param dtypes: dict of column names and NumPy dtypes
+        :return: OrderedDict of column names and NumPy arrays
+        """
+        statement = get_select(query_or_model, columns)
+        engine = self._get_read_engine()
+        with engine.connect() as connection:
+            return fetch_arrays(connection, statement, chunk_size, dtypes,
+                                engine.dialect.supports_server_side_cursors)
+
+    def _get_read_engine(self):
+        engine = self.engine
+        if self.router is not None:
+            return self.router.get_read_engine()
+        return engine
+
+    def bulk_insert(self, model, rows, batch_size=1000):
+        """
+        Inserts rows in batches by Core executemany calls, bypassing the session.
+        Each batch gets committed on its own.
+
+        :param model: sqlalchemy table, mapped class or :class:`~.DatabaseModel`
+        :param rows: iterable of dicts or tuples. Tuples must contain a value for each column in column order.
+        :param batch_size: Number of rows per batch
+        :return: dict with rows, batches, time and batch_times (seconds per batch)
+        """
+        return gw_sql_bulk.bulk_insert(self.engine, get_table(model), rows, batch_size)
+
+    def bulk_upsert(self, model, rows, batch_size=1000, index_elements=None):
+        """
+        Inserts rows in batches and updates already existing ones.
+        Uses ``ON CONFLICT`` or ``ON DUPLICATE KEY UPDATE``, if the database supports it.
+
+        :param model: sqlalchemy table, mapped class or :class:`~.DatabaseModel`
+        :param rows: iterable of dicts or tuples. Tuples must contain a value for each column in column order.
+        :param batch_size: Number of rows per batch
+        :param index_elements: Column names, which identify a row. Default are the primary key columns.
+        :return: dict with rows, batches, time, batch_times (seconds per batch) and the used upsert method
+        """
+        table = get_table(model)
+        report = gw_sql_bulk.bulk_upsert(self.engine, table, rows, batch_size, index_elements)
+        # Upserts bypass the session, so cached objects of the table may be outdated now
+        for mapper in self.Base.registry.mappers:
+            if table in mapper.tables:
+                self.identity_cache.evict(mapper.class_)
+        return report
+
+
+class _LazyQueryProperty(object):
+    """
+    Descriptor for Base.query, which asks the database for its session on first access.
+    """
+
+    def __init__(self, database):
+        self.database = database
+
+    def __get__(self, instance, owner):
+        if self.database._query_property is None:
+            self.database._build()
+        return self.database._query_property.__get__(instance, owner)
+
 
 class DatabaseClass:
     def __init__(self, database, plugin=None, app=None):
@@ -204,7 +1089,19 @@ class DatabaseClass:
         self.app = app
         self._classes = {}
 
-    def register(self, clazz, name=None, description=None):
+    def register(self, clazz, name=None, description=None, identity_cache=False, indexes=None):
+        """
+        Registers a class of the database.
+
+        :param clazz: class, which inherits from ``database.Base``
+        :param name: name of the class. Default is the class name.
+        :param description: description of the class. Default is taken from the docstring.
+        :param identity_cache: If True, loads by primary key (``query.get()`` and ``database.get()``)
+                               use the identity cache of the database.
+        :param indexes: list of indexes the class relies on for lookups and sorting, e.g.
+                        ``["name", ["name", "-created"], {"columns": ["email"], "unique": True, "where": "active"}]``.
+                        Missing ones get created in the background, see :class:`~.IndexManager`.
+        """
         if name is None:
             name = clazz.__name__
 
@@ -222,7 +1119,20 @@ class DatabaseClass:
         # TempClass = type(clazz.__name__, (self._Base, clazz), dict())
         # self._classes[name] = TempClass
 
+        cache = getattr(self.database, "identity_cache", None)
+        if identity_cache and cache is None:
+            raise ValueError("Database %s does not support an identity cache" % self.database.name)
+        index_manager = getattr(self.database, "indexes", None)
+        if indexes and index_manager is None:
+            raise ValueError("Database %s does not support index declarations" % self.database.name)
+        if indexes:
+            index_manager.declare(get_table(clazz), indexes)
+
         self._classes[name] = DatabaseModel(clazz, self.database, self.plugin, self.app, description=description)
+        if identity_cache:
+            cache.enable(clazz)
+        if indexes and self.database.is_built:
+            index_manager.ensure(self.database.engine)
         if self.plugin is not None:
             self.plugin.signals.send("db_class_registered", database=self.database, db_class=clazz)
         else:
@@ -231,7 +1141,14 @@ class DatabaseClass:
         return self._classes[name]
 
     def unregister(self, name):
-        return self._classes.pop(name, None)
+        model = self._classes.pop(name, None)
+        cache = getattr(self.database, "identity_cache", None)
+        if model is not None and cache is not None:
+            cache.disable(model.clazz)
+        index_manager = getattr(self.database, "indexes", None)
+        if model is not None and index_manager is not None and hasattr(model.clazz, "__table__"):
+            index_manager.remove(model.clazz.__table__)
+        return model
 
     def get(self, clazz_name=None):
         if clazz_name is None:
@@ -243,40 +1160,69 @@ class DatabaseClass:
 
 
 class DatabaseModel:
+    """
+    A class registered for a database.
+
+    Description and parameters get introspected from docstring and columns of the class on first access
+    and are memoized per class, see :func:`~.get_class_metadata`.
+    If the application config contains ``DATABASE_INTROSPECTION_CACHE``, it is used as path of a file,
+    which persists the introspected data between restarts.
+    """
+
     def __init__(self, clazz, database, plugin, app, description=None):
         self.clazz = clazz
         self.database = database
         self.plugin = plugin
         self.app = app
 
-        self.description = description
+        self._description = description
+        self._parameters = None
         self.arguments = {}
 
-        parsed_doc = parse(clazz.__doc__)
-        if self.description is None:
-            if parsed_doc.short_description is not None:
-                self.description = parsed_doc.short_description
-            if parsed_doc.short_description is not None:
-                self.description += '\n'
-            if parsed_doc.long_description is not None:
-                self.description += parsed_doc.long_description
-
-        self.parameters = {}
-        for parameter in parsed_doc.params:
-            self.parameters[parameter.arg_name] = {
-                'name': parameter.arg_name,
-                'description': parameter.description,
-                'type': parameter.type_name
-            }
-
-        for element_key in clazz.__dict__.keys():
-            element = getattr(clazz, element_key)
-            if isinstance(element, InstrumentedAttribute) and element.key not in self.parameters.keys():
-                self.parameters[element.key] = {
-                    'name': element.key,
-                    'description': '',
-                    'type': ''
-                }
+    @property
+    def description(self):
+        if self._description is None:
+            self._description = self._get_metadata()["description"]
+        return self._description
+
+    @description.setter
+    def description(self, description):
+        self._description = description
+
+    @property
+    def parameters(self):
+        if self._parameters is None:
+            # Copy, so that changes of a model do not change the memoized data of the class
+            self._parameters = dict((name, dict(parameter))
+                                    for name, parameter in self._get_metadata()["parameters"].items())
+        return self._parameters
+
+    @parameters.setter
+    def parameters(self, parameters):
+        self._parameters = parameters
+
+    def paginate(self, page_size=20, cursor=None, order_by=None, query=None):
+        """
+        Returns a page of objects by keyset pagination, so that deep pages are as fast as the first one::
+
+            page = db.classes.get("User").paginate(page_size=50, order_by=["-created"])
+            page = db.classes.get("User").paginate(page_size=50, order_by=["-created"], cursor=page.next_cursor)
+
+        :param page_size: Number of objects per page
+        :param cursor: next_cursor or previous_cursor of a :class:`~.Page`. None returns the first page.
+        :param order_by: list of attribute names to sort by, "-" as prefix sorts descending.
+                         The primary key is always added as last sort key. Default is the primary key.
+        :param query: query of the class to page through, e.g. with filters. Default are all objects.
+        :return: :class:`~.Page`
+        """
+        if query is None:
+            query = self.database.session.query(self.clazz)
+        return paginate(query, self.clazz, page_size, cursor, order_by)
+
+    def _get_metadata(self):
+        app = self.plugin.app if self.plugin is not None else self.app
+        cache_path = app.config.get("DATABASE_INTROSPECTION_CACHE", None) if app is not None else None
+        return get_class_metadata(self.clazz, cache_path)
 
 
 class DatabaseExistException(BaseException):
@@ -0,0 +1,270 @@
+import threading
+import time
+
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy import pool as sa_pool
+from sqlalchemy.engine.url import make_url
+
+from groundwork_database.patterns.gw_sql_sqlite import apply_sqlite_pragmas
+
+
+def get_engine_options(pool_class=None, pool_size=None, max_overflow=None, pool_timeout=None, pool_recycle=None,
+                       pool_pre_ping=None):
+    """
+    Returns the keyword arguments for ``create_engine`` for the given pool settings.
+    Settings, which are None, are not part of the result, so that SQLAlchemy defaults are used.
+
+    :param pool_class: Pool class or name of a pool class from ``sqlalchemy.pool``, e.g. "QueuePool"
+    :param pool_size: Number of connections to keep open inside the pool
+    :param max_overflow: Number of connections, which can be opened additionally to pool_size
+    :param pool_timeout: Seconds to wait for a free connection, before an error gets raised
+    :param pool_recycle: Seconds after which a connection gets recycled
+    :param pool_pre_ping: If True, connections get tested for liveness on checkout
+    :return: dict of engine options
+    """
+    if pool_class is not None and not isinstance(pool_class, type):
+        try:
+            pool_class = getattr(sa_pool, pool_class)
+        except AttributeError:
+            raise ValueError("Unknown pool class %s" % pool_class)
+
+    options = {
+        "poolclass": pool_class,
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": pool_timeout,
+        "pool_recycle": pool_recycle,
+        "pool_pre_ping": pool_pre_ping,
+    }
+    return dict((key, value) for key, value in options.items() if value is not None)
+
+
+def is_thread_bound(url, pool_class=None):
+    """
+    True, if each thread gets its own connection and so its own database, e.g. for in-memory SQLite or a
+    SingletonThreadPool or StaticPool. Work of background threads is not visible for other threads then.
+
+    :param url: SQLAlchemy database url
+    :param pool_class: Pool class of the engine. None for the default pool of the url.
+    """
+    if pool_class is not None and issubclass(pool_class, (sa_pool.SingletonThreadPool, sa_pool.StaticPool)):
+        return True
+    return not EngineRegistry.is_shareable(url)
+
+
+def acquire_engine(url, options, sqlite_pragmas=None, engine_registry=None):
+    """
+    Returns a new engine and its :class:`~.PoolStatistics` or a shared one of the engine registry.
+
+    :param url: SQLAlchemy database url
+    :param options: keyword arguments for create_engine
+    :param sqlite_pragmas: dict of PRAGMAs, which get executed on every new connection of a SQLite engine
+    :param engine_registry: :class:`~.EngineRegistry`. None creates an engine, which is not shared.
+    :return: tuple of engine and pool statistics
+    """
+    if engine_registry is not None:
+        return engine_registry.acquire(url, options, sqlite_pragmas)
+    engine = create_engine(url, **options)
+    apply_sqlite_pragmas(engine, sqlite_pragmas or {})
+    return engine, PoolStatistics(engine)
+
+
+def release_engine(engine, engine_registry=None):
+    """
+    Releases an engine of :func:`acquire_engine`.
+
+    :return: True, if the engine got disposed
+    """
+    if engine_registry is not None:
+        return engine_registry.release(engine)
+    engine.dispose()
+    return True
+
+
+class PoolStatistics:
+    """
+    Collects live usage statistics of the connection pool of an engine.
+
+    Checkouts and checkins are counted by pool events. The time needed to get a connection from the pool
+    (including the time waiting for a free one) is measured around ``pool.connect``.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._lock = threading.Lock()
+
+        self.connects = 0
+        self.closes = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.checkout_latency_max = 0.0
+        self.checkout_latency_last = 0.0
+
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "close", self._on_close)
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+        # engine.dispose() replaces the pool, so the new one needs to get measured as well
+        event.listen(engine, "engine_disposed", self._on_engine_disposed)
+        self._measure(engine.pool)
+
+    @property
+    def checked_out(self):
+        """
+        Number of connections, which are currently checked out from the pool.
+        """
+        return self.checkouts - self.checkins
+
+    def _measure(self, pool):
+        connect = pool.connect
+
+        def measured_connect():
+            start = time.time()
+            try:
+                return connect()
+            except exc.TimeoutError:
+                with self._lock:
+                    self.timeouts += 1
+                raise
+            finally:
+                latency = time.time() - start
+                with self._lock:
+                    self.wait_time += latency
+                    self.checkout_latency_last = latency
+                    self.checkout_latency_max = max(self.checkout_latency_max, latency)
+
+        pool.connect = measured_connect
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _on_close(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.closes += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.checkins += 1
+
+    def _on_engine_disposed(self, engine):
+        self._measure(engine.pool)
+
+    def to_dict(self):
+        """
+        Returns the current statistics.
+
+        :return: dict of statistics
+        """
+        pool = self.engine.pool
+        with self._lock:
+            stats = {
+                "pool_class": pool.__class__.__name__,
+                "pool_size": None,
+                "checked_out": self.checkouts - self.checkins,
+                "checked_in": None,
+                "overflow": None,
+                "connects": self.connects,
+                "closes": self.closes,
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_time": self.wait_time,
+                "checkout_latency_avg": self.wait_time / self.checkouts if self.checkouts else 0.0,
+                "checkout_latency_max": self.checkout_latency_max,
+                "checkout_latency_last": self.checkout_latency_last,
+            }
+
+        # Only QueuePool based pools know about their size and overflow
+        if isinstance(pool, sa_pool.QueuePool):
+            stats["pool_size"] = pool.size()
+            stats["checked_in"] = pool.checkedin()
+            stats["overflow"] = max(pool.overflow(), 0)
+        return stats
+
+
+class EngineRegistry:
+    """
+    Reference counted registry of engines.
+
+    Databases with equal url and engine options share one engine and therefore one connection pool.
+    In-memory SQLite urls are never shared, because every engine of them is a database on its own.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._engines = {}
+
+    @staticmethod
+    def is_shareable(url):
+        url = make_url(url)
+        return not (url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"))
+
+    def acquire(self, url, options, sqlite_pragmas=None):
+        """
+        Returns the engine and its :class:`~.PoolStatistics` for the given url and options.
+        The engine gets created, if no one exists for this combination.
+
+        :param url: SQLAlchemy database url
+        :param options: keyword arguments for create_engine
+        :param sqlite_pragmas: dict of PRAGMAs, which get executed on every new connection of a SQLite engine
+        :return: tuple of engine and pool statistics
+        """
+        sqlite_pragmas = sqlite_pragmas or {}
+        if self.is_shareable(url):
+            # str() of an URL object masks the password, so urls with different passwords would share an engine
+            key = (make_url(url).render_as_string(hide_password=False),
+                   tuple(sorted(options.items(), key=lambda item: item[0])), tuple(sorted(sqlite_pragmas.items())))
+        else:
+            key = object()
+
+        with self._lock:
+            entry = self._engines.get(key)
+            if entry is None:
+                engine = create_engine(url, **options)
+                apply_sqlite_pragmas(engine, sqlite_pragmas)
+                entry = self._engines[key] = {
+                    "engine": engine,
+                    "statistics": PoolStatistics(engine),
+                    "references": 0,
+                }
+            entry["references"] += 1
+            return entry["engine"], entry["statistics"]
+
+    def release(self, engine):
+        """
+        Releases one reference of an engine. The engine gets disposed, if it was the last reference.
+
+        :param engine: engine, which was returned by :func:`acquire`
+        :return: True, if the engine got disposed
+        """
+        with self._lock:
+            for key, entry in self._engines.items():
+                if entry["engine"] is engine:
+                    entry["references"] -= 1
+                    if entry["references"] > 0:
+                        return False
+                    del self._engines[key]
+                    break
+            else:
+                return False
+        engine.dispose()
+        return True
+
+    def references(self, engine):
+        """
+        Returns the number of databases, which are using the given engine.
+        """
+        with self._lock:
+            for entry in self._engines.values():
+                if entry["engine"] is engine:
+                    return entry["references"]
+        return 0
+
+    def __len__(self):
+        return len(self._engines)
@@ -0,0 +1,169 @@
+import itertools
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.sql.expression import CompoundSelect, Select
+
+from groundwork_database.patterns.gw_sql_identity import CachingSession
+
+#: Key of the replica router inside ``Session.info``
+ROUTER_KEY = "replica_router"
+_WROTE_KEY = "replica_router_wrote"
+
+
+class Replica:
+    """
+    A read replica of a database.
+    """
+
+    def __init__(self, url, engine, statistics):
+        self.url = url
+        self.engine = engine
+        #: :class:`~.PoolStatistics` of the replica engine
+        self.statistics = statistics
+        #: Number of statements routed to this replica
+        self.reads = 0
+
+
+class RoundRobinPolicy:
+    """
+    Uses the replicas one after another.
+    """
+
+    def __init__(self):
+        self._counter = itertools.count()
+
+    def __call__(self, replicas):
+        return replicas[next(self._counter) % len(replicas)]
+
+
+class LeastCheckedOutPolicy:
+    """
+    Uses the replica with the fewest checked out connections.
+    """
+
+    def __call__(self, replicas):
+        return min(replicas, key=lambda replica: replica.statistics.checked_out)
+
+
+REPLICA_POLICIES = {
+    "round_robin": RoundRobinPolicy,
+    "least_checked_out": LeastCheckedOutPolicy,
+}
+
+
+def get_replica_policy(policy):
+    """
+    Returns a replica policy for the given name or callable.
+    A policy is a callable, which gets the list of :class:`~.Replica` objects and returns one of them.
+    """
+    if callable(policy):
+        return policy
+    if policy in REPLICA_POLICIES.keys():
+        return REPLICA_POLICIES[policy]()
+    raise ValueError("Unknown replica policy %s. Use a callable or one of: %s"
+                     % (policy, ", ".join(REPLICA_POLICIES.keys())))
+
+
+class ReplicaRouter:
+    """
+    Decides, if a statement gets executed on the primary database or on one of its replicas.
+
+    Selects go to a replica chosen by the policy. Writes, selects with ``FOR UPDATE`` and all statements of a
+    transaction, which has already written, go to the primary.
+    After a commit with writes, the reads of the committing thread stay pinned to the primary for pin_time
+    seconds, so that it reads its own writes even if replicas lag behind.
+    """
+
+    def __init__(self, primary, replicas, policy="round_robin", pin_time=1.0):
+        self.primary = primary
+        self.replicas = replicas
+        self.policy = get_replica_policy(policy)
+        self.pin_time = pin_time
+        self._pins = threading.local()
+        self._lock = threading.Lock()
+        #: Number of statements routed to the primary
+        self.primary_statements = 0
+
+    def pin(self):
+        self._pins.until = time.time() + self.pin_time
+
+    def is_pinned(self):
+        return getattr(self._pins, "until", 0) > time.time()
+
+    def get_bind(self, session, clause, primary=False):
+        if primary or not self.replicas or session.info.get(_WROTE_KEY) or not _is_read(clause) \
+                or self.is_pinned():
+            if clause is not None and not _is_read(clause):
+                session.info[_WROTE_KEY] = True
+            with self._lock:
+                self.primary_statements += 1
+            return self.primary
+
+        replica = self.policy(self.replicas)
+        with self._lock:
+            replica.reads += 1
+        return replica.engine
+
+    def get_read_engine(self):
+        """
+        Returns the engine for a read, which does not belong to a session.
+        """
+        if not self.replicas or self.is_pinned():
+            with self._lock:
+                self.primary_statements += 1
+            return self.primary
+
+        replica = self.policy(self.replicas)
+        with self._lock:
+            replica.reads += 1
+        return replica.engine
+
+    def to_dict(self):
+        return {
+            "primary_statements": self.primary_statements,
+            "replicas": [{"url": replica.url, "reads": replica.reads} for replica in self.replicas],
+        }
+
+
+class RoutingSession(CachingSession):
+    """
+    Session, which routes statements by the :class:`~.ReplicaRouter` stored in ``Session.info``.
+    Reads with ``bind_arguments={"primary": True}`` go to the primary database.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        router = self.info.get(ROUTER_KEY)
+        if router is None or self._flushing:
+            return super(RoutingSession, self).get_bind(mapper, clause=clause, **kwargs)
+        return router.get_bind(self, clause, kwargs.get("primary", False))
+
+
+def _is_read(clause):
+    if not isinstance(clause, (Select, CompoundSelect)):
+        return False
+    return getattr(clause, "_for_update_arg", None) is None
+
+
+def has_writes(session):
+    """
+    Returns True, if the session has written inside its transaction or has changes, which are not flushed yet.
+    """
+    return bool(session.info.get(_WROTE_KEY) or session.new or session.dirty or session.deleted)
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _after_flush(session, flush_context):
+    session.info[_WROTE_KEY] = True
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _after_commit(session):
+    if session.info.pop(_WROTE_KEY, False) and ROUTER_KEY in session.info:
+        session.info[ROUTER_KEY].pin()
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _after_rollback(session):
+    session.info.pop(_WROTE_KEY, None)
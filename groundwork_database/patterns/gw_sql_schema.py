@@ -0,0 +1,82 @@
+import hashlib
+import time
+
+from sqlalchemy import Column, Float, MetaData, String, Table, inspect, select
+
+#: Name of the bookkeeping table, which stores the schema fingerprint per database
+FINGERPRINT_TABLE = "gw_schema_fingerprints"
+
+_fingerprint_metadata = MetaData()
+_fingerprints = Table(FINGERPRINT_TABLE, _fingerprint_metadata,
+                      Column("database", String(255), primary_key=True),
+                      Column("fingerprint", String(64), nullable=False),
+                      Column("updated", Float, nullable=False))
+
+
+def get_schema_fingerprint(metadata):
+    """
+    Returns a hash over tables, columns, constraints and indexes of the given metadata.
+    """
+    parts = []
+    for table in sorted(metadata.tables.values(), key=lambda table: table.fullname):
+        parts.append("table %s" % table.fullname)
+        for column in table.columns:
+            parts.append("column %s %r nullable=%s primary_key=%s unique=%s"
+                         % (column.name, column.type, column.nullable, column.primary_key, column.unique))
+            for foreign_key in sorted(column.foreign_keys, key=lambda foreign_key: foreign_key.target_fullname):
+                parts.append("foreign_key %s" % foreign_key.target_fullname)
+        for index in sorted(table.indexes, key=lambda index: index.name or ""):
+            columns = [column.name for column in index.columns]
+            parts.append("index %s %s unique=%s" % (index.name, columns, index.unique))
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+def create_schema(connection, metadata, name, force=False):
+    """
+    Creates missing tables and indexes of the metadata.
+
+    The fingerprint of the metadata gets stored inside :data:`FINGERPRINT_TABLE`. If it has not changed since
+    the last call, the database does not get inspected at all. Tables or indexes dropped by someone else are
+    therefore only recreated with ``force=True`` or after a change of the metadata.
+
+    :param connection: sqlalchemy connection, whose transaction gets used
+    :param metadata: metadata of the tables to create
+    :param name: name of the database, used as key of the stored fingerprint
+    :param force: If True, the database gets inspected even if the fingerprint matches
+    :return: dict with fingerprint, skipped, created_tables and created_indexes
+    """
+    fingerprint = get_schema_fingerprint(metadata)
+    report = {
+        "fingerprint": fingerprint,
+        "skipped": False,
+        "created_tables": [],
+        "created_indexes": [],
+    }
+
+    inspector = inspect(connection)
+    if not inspector.has_table(FINGERPRINT_TABLE):
+        _fingerprints.create(connection)
+    elif not force:
+        stored = connection.execute(select(_fingerprints.c.fingerprint)
+                                    .where(_fingerprints.c.database == name)).scalar()
+        if stored == fingerprint:
+            report["skipped"] = True
+            return report
+
+    existing_tables = {}
+    for table in metadata.sorted_tables:
+        if table.schema not in existing_tables:
+            existing_tables[table.schema] = set(inspector.get_table_names(schema=table.schema))
+        if table.name not in existing_tables[table.schema]:
+            table.create(connection)
+            report["created_tables"].append(table.fullname)
+            continue
+        existing_indexes = set(index["name"] for index in inspector.get_indexes(table.name, schema=table.schema))
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(connection)
+                report["created_indexes"].append(index.name)
+
+    connection.execute(_fingerprints.delete().where(_fingerprints.c.database == name))
+    connection.execute(_fingerprints.insert().values(database=name, fingerprint=fingerprint, updated=time.time()))
+    return report
@@ -0,0 +1,431 @@
+import collections
+import logging
+import time
+import zlib
+
+import sqlalchemy
+from sqlalchemy import delete, func, inspect, select, tuple_
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.orm import Query, scoped_session, sessionmaker
+from sqlalchemy.sql.expression import Select
+
+from groundwork_database.patterns import gw_sql_bulk
+from groundwork_database.patterns.gw_sql_fetch import fetch_rows, get_select
+from groundwork_database.patterns.gw_sql_instrumentation import get_query_statistics, sort_statements, summarize
+from groundwork_database.patterns.gw_sql_pattern import DatabaseClass
+from groundwork_database.patterns.gw_sql_pool import acquire_engine, get_engine_options, release_engine
+from groundwork_database.patterns.gw_sql_schema import create_schema
+from groundwork_database.patterns.gw_sql_sqlite import get_sqlite_pragmas, is_sqlite
+from groundwork_database.patterns.gw_sql_utils import SessionTracker, count_rows, get_database_size, get_table
+
+
+class ShardedDatabase:
+    """
+    A logical sql database, whose rows are spread over several databases (shards), registered by a plugin or
+    the application. It gets registered by passing a list or dict of urls to ``databases.register()``::
+
+        db = self.databases.register("events", ["sqlite:///events_0.db", "sqlite:///events_1.db"], "Events",
+                                     shard_key=lambda clazz, identity: identity[0])
+
+    All shards share one ``Base`` and one namespace of classes and use the same schema.
+    The shard of an object is chosen by its primary key: the shard key function gets the class and the primary key
+    tuple and returns a shard key, whose hash selects the shard. Without a function, the primary key itself is the
+    shard key. So primary keys must be set by the application before adding an object, e.g. as UUID,
+    and must be unique across all shards.
+
+    Writes of objects and loads by primary key (``get()``) go to a single shard. Queries without a shard key get
+    executed on every shard and their results get combined (scatter-gather), like ``query(User).filter(...)``.
+    Ordering, limits and aggregates apply per shard, so aggregates return one row per shard and
+    ``query(...).count()`` fails. :func:`count` sums the counts of all shards instead.
+    ``query(...).set_shard("name")`` or the option ``set_shard_id("name")`` limits a query to a single shard.
+
+    If shards get added or the shard key function changes, :func:`rebalance` moves rows to their new shards.
+
+    Features of :class:`~.Database`, which rely on a single engine (replicas, caches, serialized writes, write
+    buffer, index declarations), are not available.
+
+    :param name: name of the database
+    :param urls: list of SQLAlchemy database urls or dict of shard name and url. Shards of a list are named
+                 "shard_0", "shard_1", ...
+    :param description: description of the database
+    :param plugin: plugin, which has registered the database
+    :param app: application, if the database was not registered by a plugin
+    :param shard_key: function, which gets the mapped class and primary key tuple and returns the shard key
+    :param pool_class: Pool class or name of a pool class from ``sqlalchemy.pool``, used for each shard
+    :param pool_size: Number of connections to keep open inside the pool of each shard
+    :param max_overflow: Number of connections, which can be opened additionally to pool_size
+    :param pool_timeout: Seconds to wait for a free connection, before an error gets raised
+    :param pool_recycle: Seconds after which a connection gets recycled
+    :param pool_pre_ping: If True, connections get tested for liveness on checkout
+    :param engine_registry: :class:`~.EngineRegistry` to share the engines with other databases.
+    :param instrument: If True, execution statistics get collected per statement, see :func:`query_stats`.
+    :param slow_query_threshold: Seconds, after which a statement gets stored in the slow query log.
+                                 Enables instrumentation.
+    :param sqlite_profile: Name of a SQLite performance profile or a dict of PRAGMAs, see :class:`~.Database`.
+    """
+
+    def __init__(self, name, urls, description, plugin=None, app=None, shard_key=None, pool_class=None,
+                 pool_size=None, max_overflow=None, pool_timeout=None, pool_recycle=None, pool_pre_ping=None,
+                 engine_registry=None, instrument=False, slow_query_threshold=None, sqlite_profile=None):
+        self.name = name
+        self.description = description
+        self.plugin = plugin
+        self.app = app
+        self.log = logging.getLogger(__name__)
+
+        if int(sqlalchemy.__version__.split(".")[0]) < 2:
+            # identity_chooser and execute_chooser of ShardedSession are not available before 2.0
+            raise ImportError("Sharded databases need SQLAlchemy >= 2.0, installed is %s. "
+                              "Install it by 'pip install \"sqlalchemy>=2.0\"'" % sqlalchemy.__version__)
+
+        if isinstance(urls, dict):
+            #: OrderedDict of shard name and url
+            self.shard_urls = collections.OrderedDict(sorted(urls.items(), key=lambda item: item[0]))
+        else:
+            self.shard_urls = collections.OrderedDict(("shard_%s" % index, url) for index, url in enumerate(urls))
+        if not self.shard_urls:
+            raise ValueError("A sharded database needs at least one url")
+        self.database_url = list(self.shard_urls.values())
+        self.shard_key = shard_key
+
+        self.engine_options = get_engine_options(pool_class, pool_size, max_overflow, pool_timeout, pool_recycle,
+                                                 pool_pre_ping)
+        self._engine_registry = engine_registry
+
+        self.sqlite_pragmas = get_sqlite_pragmas(sqlite_profile)
+        if self.sqlite_pragmas and not all(is_sqlite(url) for url in self.database_url):
+            raise ValueError("SQLite profiles can only be used for SQLite databases")
+        self.sqlite_profile = sqlite_profile
+
+        self.instrument = instrument or slow_query_threshold is not None
+        self.slow_query_threshold = slow_query_threshold
+
+        start = time.time()
+        #: OrderedDict of shard name and engine
+        self.engines = collections.OrderedDict()
+        self._pool_statistics = collections.OrderedDict()
+        for shard, url in self.shard_urls.items():
+            self.engines[shard], self._pool_statistics[shard] = acquire_engine(url, self.engine_options,
+                                                                               self.sqlite_pragmas,
+                                                                               self._engine_registry)
+        self.query_statistics = collections.OrderedDict()
+        if self.instrument:
+            for shard, engine in self.engines.items():
+                self.query_statistics[shard] = get_query_statistics(engine, slow_query_threshold)
+
+        self._session_factory = sessionmaker(class_=ShardedSession, autocommit=False, autoflush=False,
+                                             shards=dict(self.engines), shard_chooser=self._choose_shard,
+                                             identity_chooser=self._choose_identity_shards,
+                                             execute_chooser=self._choose_execute_shards)
+        self._sessions = SessionTracker()
+        self._sessions.attach(self._session_factory)
+        self.session = scoped_session(self._session_factory)
+        self.build_time = time.time() - start
+
+        self.Base = declarative_base()
+        self.Base.query = self.session.query_property()
+        self.classes = DatabaseClass(self, self.plugin, self.app)
+
+    @property
+    def is_built(self):
+        return self.engines is not None
+
+    def get_shard(self, clazz, identity):
+        """
+        Returns the name of the shard, which stores the object with the given primary key.
+
+        :param clazz: mapped class or :class:`~.DatabaseModel`
+        :param identity: primary key value or tuple of values for composite primary keys
+        :return: shard name
+        """
+        clazz = getattr(clazz, "clazz", clazz)
+        if not isinstance(identity, (tuple, list)):
+            identity = (identity,)
+        identity = tuple(identity)
+        if any(value is None for value in identity):
+            raise ValueError("Primary key of %s must be set to choose its shard" % clazz.__name__)
+        key = self.shard_key(clazz, identity) if self.shard_key is not None else identity
+        # crc32 is stable between processes, unlike hash() of strings
+        index = zlib.crc32(repr(key).encode("utf-8")) % len(self.shard_urls)
+        return list(self.shard_urls.keys())[index]
+
+    def _choose_shard(self, mapper, instance, clause=None):
+        if instance is None:
+            raise ValueError("Statement of database %s has no shard key. "
+                             "Execute it with execution_options(shard_id=...)" % self.name)
+        return self.get_shard(mapper.class_, mapper.primary_key_from_instance(instance))
+
+    def _choose_identity_shards(self, mapper, primary_key, **kwargs):
+        return [self.get_shard(mapper.class_, primary_key)]
+
+    def _choose_execute_shards(self, orm_context):
+        return list(self.engines.keys())
+
+    def create_all(self, force=False):
+        """
+        Creates missing tables and indexes of all classes on every shard, see :func:`~.create_schema`.
+
+        :param force: If True, the shards get checked for missing tables and indexes in any case
+        :return: dict of shard name and dict with fingerprint, skipped, created_tables and created_indexes
+        """
+        reports = collections.OrderedDict()
+        for shard, engine in self.engines.items():
+            with engine.begin() as connection:
+                reports[shard] = create_schema(connection, self.Base.metadata, "%s.%s" % (self.name, shard), force)
+        return reports
+
+    def query(self, *args, **kwargs):
+        return self.session.query(*args, **kwargs)
+
+    def get(self, model, ident):
+        """
+        Returns the object of a class by its primary key or None. Only the shard of the primary key gets asked.
+
+        :param model: mapped class or :class:`~.DatabaseModel`
+        :param ident: primary key value or tuple of values for composite primary keys
+        """
+        return self.session.get(getattr(model, "clazz", model), ident)
+
+    def add(self, *args, **kwargs):
+        return self.session.add(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self.session.delete(*args, **kwargs)
+
+    def commit(self, *args, **kwargs):
+        return self.session.commit(*args, **kwargs)
+
+    def rollback(self, *args, **kwargs):
+        return self.session.rollback(*args, **kwargs)
+
+    def close(self, *args, **kwargs):
+        return self.session.close(*args, **kwargs)
+
+    def fetch(self, query_or_model, columns=None, named=False, shards=None):
+        """
+        Returns the rows of a select of all or the given shards as tuples, without creating ORM objects.
+        Shards get queried at the same time by the fan-out pool of the application, see :class:`~.FanOut`.
+        Inside a function of a fan-out, they get queried one after another by its worker.
+        Rows are ordered by shard, so ORDER BY and LIMIT apply per shard.
+
+        :param query_or_model: select statement, textual statement, query, sqlalchemy table, mapped class or
+                               :class:`~.DatabaseModel`
+        :param columns: names of the columns to select from a table or model. Default are all columns.
+        :param named: If True, rows support access by column name (``row.name``)
+        :param shards: list of shard names. Default are all shards.
+        :return: list of rows
+        """
+        statement = get_select(query_or_model, columns)
+        engines = self._get_engines(shards)
+
+        def fetch(engine):
+            with engine.connect() as connection:
+                return fetch_rows(connection, statement, named)
+
+        app = self.plugin.app if self.plugin is not None else self.app
+        fan_out_pool = getattr(getattr(app, "databases", None), "fan_out_pool", None)
+        if fan_out_pool is None or len(engines) == 1:
+            return [row for engine in engines.values() for row in fetch(engine)]
+
+        result = fan_out_pool.run(engines, fetch)
+        for shard, error in result.errors.items():
+            raise error
+        return result.merge()
+
+    def count(self, query_or_model, shards=None):
+        """
+        Returns the number of rows of a class or select summed over all or the given shards.
+
+        :param query_or_model: select statement, query, sqlalchemy table, mapped class or :class:`~.DatabaseModel`
+        :param shards: list of shard names. Default are all shards.
+        :return: int
+        """
+        if isinstance(query_or_model, (Query, Select)):
+            statement = select(func.count()).select_from(get_select(query_or_model).subquery())
+        else:
+            statement = select(func.count()).select_from(get_table(query_or_model))
+        return sum(row[0] for row in self.fetch(statement, shards=shards))
+
+    def _get_engines(self, shards=None):
+        if shards is None:
+            return self.engines
+        unknown = [shard for shard in shards if shard not in self.engines.keys()]
+        if unknown:
+            raise ValueError("Unknown shards of database %s: %s" % (self.name, ", ".join(unknown)))
+        return collections.OrderedDict((shard, self.engines[shard]) for shard in shards)
+
+    def rebalance(self, model, batch_size=1000, dry_run=False):
+        """
+        Moves the rows of a class to the shards chosen by the current shard key function, e.g. after shards got
+        added or the function got changed. Sessions are bypassed, so objects loaded before may be outdated.
+
+        Each shard gets read in batches of batch_size rows, ordered by primary key. Rows of a batch, which belong to
+        another shard, get upserted there first and deleted from their old shard afterwards. An interrupted
+        rebalance therefore leaves duplicates, but loses no rows, and can simply be started again.
+        Writes to the class should be stopped during the rebalance.
+
+        :param model: mapped class or :class:`~.DatabaseModel`
+        :param batch_size: Number of rows, which get read and moved at once
+        :param dry_run: If True, rows only get checked and counted, but not moved
+        :return: dict with checked, moved, batches, time and moves (dict of "source->target" and number of rows)
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        clazz = getattr(model, "clazz", model)
+        table = get_table(clazz)
+        primary_key = list(table.primary_key.columns)
+        key = tuple_(*primary_key) if len(primary_key) > 1 else primary_key[0]
+
+        start = time.time()
+        report = {"checked": 0, "moved": 0, "batches": 0, "time": 0.0, "moves": {}}
+        for source, source_engine in self.engines.items():
+            last = None
+            while True:
+                statement = select(table).order_by(*primary_key).limit(batch_size)
+                if last is not None:
+                    statement = statement.where(key > (tuple_(*last) if len(primary_key) > 1 else last[0]))
+                with source_engine.connect() as connection:
+                    rows = [dict(row) for row in connection.execute(statement).mappings()]
+                if not rows:
+                    break
+                last = [rows[-1][column.name] for column in primary_key]
+                report["batches"] += 1
+                report["checked"] += len(rows)
+
+                targets = collections.OrderedDict()
+                for row in rows:
+                    target = self.get_shard(clazz, [row[column.name] for column in primary_key])
+                    if target != source:
+                        targets.setdefault(target, []).append(row)
+
+                for target, moved_rows in targets.items():
+                    if not dry_run:
+                        gw_sql_bulk.bulk_upsert(self.engines[target], table, moved_rows, batch_size)
+                        identities = [tuple(row[column.name] for column in primary_key) for row in moved_rows]
+                        if len(primary_key) == 1:
+                            condition = key.in_([identity[0] for identity in identities])
+                        else:
+                            condition = key.in_(identities)
+                        with source_engine.begin() as connection:
+                            connection.execute(delete(table).where(condition))
+                    move = "%s->%s" % (source, target)
+                    report["moves"][move] = report["moves"].get(move, 0) + len(moved_rows)
+                    report["moved"] += len(moved_rows)
+
+                if len(rows) < batch_size:
+                    break
+        report["time"] = time.time() - start
+        self.log.info("Rebalance of %s in database %s: %s" % (clazz.__name__, self.name, report))
+        return report
+
+    def pool_stats(self):
+        """
+        Returns the summed statistics of the connection pools of all shards.
+        Statistics of each shard are stored as dict under "shards".
+
+        :return: dict of statistics
+        """
+        shards = collections.OrderedDict((shard, statistics.to_dict())
+                                         for shard, statistics in self._pool_statistics.items())
+        stats = {"pool_class": list(shards.values())[0]["pool_class"], "shards": shards}
+        for name in ("checked_out", "overflow", "connects", "closes", "checkouts", "timeouts", "wait_time"):
+            stats[name] = sum(shard[name] or 0 for shard in shards.values())
+        return stats
+
+    def query_stats(self, order_by="total_time", limit=None):
+        """
+        Returns execution statistics per normalized statement. Each statement contains the name of its shard.
+        See :func:`Database.query_stats`.
+        """
+        statements = []
+        for shard, statistics in self.query_statistics.items():
+            for statement in statistics.statements():
+                statement["shard"] = shard
+                statements.append(statement)
+        return sort_statements(statements, order_by, limit)
+
+    def get_query_statistics(self):
+        """
+        Returns the :class:`~.QueryStatistics` of all shards. Empty, if instrumentation is not enabled.
+        """
+        return list(self.query_statistics.values())
+
+    def slow_queries(self):
+        """
+        Returns the slow query logs of all shards, oldest first. See :func:`Database.slow_queries`.
+        """
+        queries = []
+        for shard, statistics in self.query_statistics.items():
+            for query in statistics.slow_queries():
+                query["shard"] = shard
+                queries.append(query)
+        queries.sort(key=lambda query: query["time"])
+        return queries
+
+    def stats(self, slowest=5):
+        """
+        Returns an overview of the database usage. See :func:`Database.stats`.
+        Rows and size are summed over all shards. Rows per table and shard are stored under "shards".
+        """
+        sizes = [get_database_size(url) for url in self.database_url]
+        stats = {
+            "name": self.name,
+            "description": self.description,
+            "url": ", ".join(make_url(url).render_as_string(hide_password=True) for url in self.database_url),
+            "built": self.is_built,
+            "build_time": self.build_time,
+            "classes": len(self.classes.get()),
+            "pool": self.pool_stats(),
+            "statements": summarize(self.query_statistics.values()) if self.query_statistics else None,
+            "slowest_statements": self.query_stats(order_by="max_time", limit=slowest),
+            "tables": {},
+            "size": sum(sizes) if None not in sizes else None,
+            "shards": collections.OrderedDict(),
+        }
+        for shard, engine in self.engines.items():
+            stats["shards"][shard] = {}
+            inspector = inspect(engine)
+            for table in self.Base.metadata.sorted_tables:
+                if inspector.has_table(table.name, schema=table.schema):
+                    rows, estimated = count_rows(engine, table)
+                    stats["shards"][shard][table.name] = rows
+                    table_stats = stats["tables"].setdefault(table.name, {"rows": 0, "estimated": False})
+                    table_stats["rows"] += rows
+                    table_stats["estimated"] = table_stats["estimated"] or estimated
+        return stats
+
+    def dispose(self):
+        """
+        Closes the sessions of all threads and releases the engines of all shards.
+        Afterwards the database can not be used anymore.
+
+        :return: dict, which reports the released resources. See :func:`Database.dispose`.
+        """
+        report = {
+            "database": self.name,
+            "sessions_closed": 0,
+            "connections_closed": 0,
+            "connections_open": 0,
+            "engine_disposed": False,
+        }
+        if self.engines is None:
+            return report
+
+        closes = dict((shard, statistics.closes) for shard, statistics in self._pool_statistics.items())
+        sessions = self._sessions.pop_all()
+        for session in sessions:
+            session.close()
+        report["sessions_closed"] = len(sessions)
+        self.session.remove()
+
+        disposed = [release_engine(engine, self._engine_registry) for engine in self.engines.values()]
+        report["engine_disposed"] = all(disposed)
+        for shard, statistics in self._pool_statistics.items():
+            report["connections_closed"] += statistics.closes - closes[shard]
+            report["connections_open"] += statistics.to_dict()["checked_out"]
+        self.engines = None
+
+        self.log.debug("Database %s disposed: %s" % (self.name, report))
+        return report
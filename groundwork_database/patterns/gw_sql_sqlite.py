@@ -0,0 +1,81 @@
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+
+#: PRAGMA settings of the SQLite performance profiles, applied on every new connection.
+#: cache_size is given in KiB (negative values), mmap_size in bytes and busy_timeout in milliseconds.
+SQLITE_PROFILES = {
+    # Survives power loss after each commit, concurrent readers do not block the writer
+    "durable": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "busy_timeout": 5000,
+    },
+    # Commits do not wait for fsync of the WAL. A power loss may lose the last commits, but never corrupts.
+    "fast-write": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -64 * 1024,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+    # Large page cache and memory mapped reads
+    "read-heavy": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -256 * 1024,
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+}
+
+# Execution order of known pragmas. Unknown ones get executed afterwards.
+_PRAGMA_ORDER = ["journal_mode", "synchronous", "cache_size", "mmap_size", "temp_store", "busy_timeout"]
+
+
+def get_sqlite_pragmas(profile):
+    """
+    Returns the PRAGMA settings for a profile.
+
+    :param profile: name of a profile from :data:`SQLITE_PROFILES` or a dict of PRAGMA names and values
+    :return: dict of PRAGMA names and values. Empty, if profile is None.
+    """
+    if profile is None:
+        return {}
+    if isinstance(profile, dict):
+        return dict(profile)
+    if profile in SQLITE_PROFILES.keys():
+        return dict(SQLITE_PROFILES[profile])
+    raise ValueError("Unknown SQLite profile %s. Use a dict of pragmas or one of: %s"
+                     % (profile, ", ".join(sorted(SQLITE_PROFILES.keys()))))
+
+
+def is_sqlite(url):
+    return make_url(url).get_backend_name() == "sqlite"
+
+
+def apply_sqlite_pragmas(engine, pragmas):
+    """
+    Executes the given PRAGMAs on every new connection of the engine.
+
+    :param engine: sqlalchemy engine of a SQLite database. For async engines use ``engine.sync_engine``.
+    :param pragmas: dict of PRAGMA names and values
+    """
+    if not pragmas:
+        return
+    statements = ["PRAGMA %s = %s" % (name, pragmas[name])
+                  for name in sorted(pragmas.keys(), key=_get_pragma_position)]
+
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+
+
+def _get_pragma_position(name):
+    # journal_mode first, because it can not be changed inside a transaction
+    return (_PRAGMA_ORDER.index(name) if name in _PRAGMA_ORDER else len(_PRAGMA_ORDER), name)
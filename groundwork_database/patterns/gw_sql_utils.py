@@ -0,0 +1,130 @@
+import os
+import threading
+import weakref
+from collections.abc import Sequence
+
+from sqlalchemy import Table, event, exc, func, inspect, select, text
+from sqlalchemy.engine.url import make_url
+
+
+def get_table(model):
+    """
+    Returns the table of a model.
+
+    :param model: sqlalchemy table, mapped class or :class:`~.DatabaseModel`
+    :return: sqlalchemy table
+    """
+    if isinstance(model, Table):
+        return model
+    # DatabaseModel, which wraps the mapped class
+    clazz = getattr(model, "clazz", model)
+    table = getattr(clazz, "__table__", None)
+    if table is None:
+        raise ValueError("%s is not a table or mapped class" % model)
+    return table
+
+
+def expunge_chunk(session, chunk):
+    """
+    Removes all mapped objects of a chunk from the session.
+    Chunk elements may be objects or rows, which contain objects.
+    """
+    for element in chunk:
+        entities = element if isinstance(element, Sequence) else (element,)
+        for entity in entities:
+            if inspect(entity, raiseerr=False) is not None and entity in session:
+                session.expunge(entity)
+
+
+def count_rows(engine, table):
+    """
+    Returns the number of rows of a table.
+    The estimation of the database statistics is used, if available, because exact counting is
+    expensive for large tables: ``pg_class.reltuples`` on PostgreSQL,
+    ``information_schema.tables`` on MySQL and ``sqlite_stat1`` (filled by ANALYZE) on SQLite.
+
+    :param engine: sqlalchemy engine
+    :param table: sqlalchemy table
+    :return: tuple of number of rows and True, if it is an estimation
+    """
+    try:
+        with engine.connect() as connection:
+            rows = _estimate_rows(connection, table)
+        if rows is not None:
+            return rows, True
+    except exc.DBAPIError:
+        pass
+
+    with engine.connect() as connection:
+        return connection.execute(select(func.count()).select_from(table)).scalar(), False
+
+
+def _estimate_rows(connection, table):
+    dialect = connection.dialect.name
+    if dialect == "postgresql":
+        name = table.name if table.schema is None else "%s.%s" % (table.schema, table.name)
+        rows = connection.execute(text("SELECT reltuples FROM pg_class WHERE oid = CAST(:name AS regclass)"),
+                                  {"name": name}).scalar()
+        # -1 means, the table was never analyzed
+        return int(rows) if rows is not None and rows >= 0 else None
+    if dialect in ("mysql", "mariadb"):
+        rows = connection.execute(text("SELECT table_rows FROM information_schema.tables "
+                                       "WHERE table_schema = DATABASE() AND table_name = :name"),
+                                  {"name": table.name}).scalar()
+        return int(rows) if rows is not None else None
+    if dialect == "sqlite":
+        if not connection.execute(text("SELECT name FROM sqlite_master "
+                                       "WHERE type = 'table' AND name = 'sqlite_stat1'")).scalar():
+            return None
+        stat = connection.execute(text("SELECT stat FROM sqlite_stat1 WHERE tbl = :name"),
+                                  {"name": table.name}).scalar()
+        # The first number of stat is the number of rows of the table
+        return int(stat.split()[0]) if stat else None
+    return None
+
+
+def get_database_size(url):
+    """
+    Returns the size in bytes of a file based SQLite database, including its journal and WAL files.
+    Returns None for all other databases.
+
+    :param url: SQLAlchemy database url
+    """
+    url = make_url(url)
+    if url.get_backend_name() != "sqlite" or url.database in (None, "", ":memory:"):
+        return None
+    if not os.path.exists(url.database):
+        return None
+    size = 0
+    for suffix in ("", "-journal", "-wal", "-shm"):
+        if os.path.exists(url.database + suffix):
+            size += os.path.getsize(url.database + suffix)
+    return size
+
+
+class SessionTracker:
+    """
+    Tracks the sessions of all threads, which have started a transaction or hold objects.
+    scoped_session only knows the session of the current thread, but all of them must be closed on dispose.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = weakref.WeakSet()
+
+    def attach(self, session_factory):
+        event.listen(session_factory, "after_begin", self._track)
+        event.listen(session_factory, "after_attach", self._track)
+
+    def _track(self, session, *args):
+        with self._lock:
+            self._sessions.add(session)
+
+    def pop_all(self):
+        """
+        Returns the tracked sessions and stops tracking them.
+        """
+        with self._lock:
+            sessions = list(self._sessions)
+            self._sessions.clear()
+        return sessions
@@ -0,0 +1,223 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class _WriteJob:
+    def __init__(self, function, args, kwargs, group=True):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        #: If True, the job gets executed together with other jobs inside one transaction
+        self.group = group
+        self.future = Future()
+
+
+class WriteScheduler:
+    """
+    Executes write transactions of a database one after another by a single writer thread.
+
+    Queued jobs get merged into one transaction (group commit), so that many small writes share one
+    commit and therefore one sync of the database file. Reads do not pass the scheduler and stay concurrent.
+
+    If a job of a group fails, the transaction gets rolled back and the jobs of the group get executed again,
+    each inside its own transaction. So only the failing job reports an error, but jobs may get called twice.
+    Jobs should therefore only change the database and not have other side effects.
+
+    Sessions of an attached session factory may only flush on the writer thread, as a flush takes the write lock of
+    the database (see :func:`attach`). Their changes get flushed by the commit on the writer thread instead.
+
+    The writer thread gets started with the first job.
+
+    :param session_factory: sessionmaker for the sessions of the writer
+    :param max_batch_size: Maximum number of jobs, which get merged into one transaction
+    :param max_delay: Seconds the writer waits for further jobs, before it executes a group.
+                      0 executes all jobs, which are already queued, without waiting.
+    """
+
+    def __init__(self, session_factory, max_batch_size=100, max_delay=0.0):
+        self.session_factory = session_factory
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+        self.jobs = 0
+        self.failed_jobs = 0
+        self.commits = 0
+        self.retried_batches = 0
+        self.max_queue_depth = 0
+        self.max_batch = 0
+        self.last_batch = 0
+        self.commit_time = 0.0
+
+    @property
+    def is_writer_thread(self):
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    def attach(self, session_factory):
+        """
+        Rejects flushes and ORM insert, update and delete statements of the sessions outside the writer thread.
+        """
+        event.listen(session_factory, "before_flush", self._before_flush)
+        event.listen(session_factory, "do_orm_execute", self._do_orm_execute)
+
+    def _before_flush(self, session, flush_context, instances):
+        if not self.is_writer_thread:
+            raise SerializedWriteException("Writes are serialized. Changes get flushed by the commit of the writer, "
+                                           "so use commit() or write() instead of flush().")
+
+    def _do_orm_execute(self, orm_execute_state):
+        if not self.is_writer_thread and (orm_execute_state.is_insert or orm_execute_state.is_update or
+                                          orm_execute_state.is_delete):
+            raise SerializedWriteException("Writes are serialized. Execute insert, update and delete statements "
+                                           "by write().")
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Queues a write job. The job gets called with a session as first argument, followed by the given arguments.
+        It must not commit the session, this is done by the writer.
+
+        :return: Future, which gets the return value of the job
+        """
+        return self._put(_WriteJob(function, args, kwargs))
+
+    def submit_commit(self, session):
+        """
+        Queues the commit of an already used session. Flush and commit get executed by the writer thread,
+        but not merged with other jobs, because the changes are bound to the given session.
+
+        :return: Future
+        """
+        return self._put(_WriteJob(lambda _: session.commit(), (), {}, group=False))
+
+    def _put(self, job):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="gw-sql-writer")
+                self._thread.daemon = True
+                self._thread.start()
+            self._queue.put(job)
+            self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        return job.future
+
+    def stop(self, timeout=None):
+        """
+        Executes all queued jobs and stops the writer thread.
+        """
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+            if thread is None:
+                return
+            self._queue.put(_STOP)
+        thread.join(timeout)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is _STOP:
+                return
+            if not job.group:
+                self._execute_single(job)
+                continue
+
+            jobs = [job]
+            deadline = time.time() + self.max_delay
+            stop = False
+            while len(jobs) < self.max_batch_size:
+                try:
+                    timeout = deadline - time.time()
+                    next_job = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if next_job is _STOP:
+                    stop = True
+                    break
+                if not next_job.group:
+                    # Keep the order of jobs: run the group first
+                    self._execute_group(jobs)
+                    jobs = []
+                    self._execute_single(next_job)
+                    break
+                jobs.append(next_job)
+            if jobs:
+                self._execute_group(jobs)
+            if stop:
+                return
+
+    def _execute_group(self, jobs):
+        session = self.session_factory(expire_on_commit=False)
+        start = time.time()
+        try:
+            results = [job.function(session, *job.args, **job.kwargs) for job in jobs]
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            session.close()
+            if len(jobs) == 1:
+                self._finish(jobs, exception=e)
+            else:
+                log.debug("Group of %s write jobs failed, executing them one by one: %s" % (len(jobs), e))
+                with self._lock:
+                    self.retried_batches += 1
+                for job in jobs:
+                    self._execute_group([job])
+            return
+        session.close()
+        self._finish(jobs, results=results, duration=time.time() - start)
+
+    def _execute_single(self, job):
+        start = time.time()
+        try:
+            result = job.function(None, *job.args, **job.kwargs)
+        except Exception as e:
+            self._finish([job], exception=e)
+            return
+        self._finish([job], results=[result], duration=time.time() - start)
+
+    def _finish(self, jobs, results=None, exception=None, duration=0.0):
+        with self._lock:
+            self.jobs += len(jobs)
+            if exception is not None:
+                self.failed_jobs += len(jobs)
+            else:
+                self.commits += 1
+                self.last_batch = len(jobs)
+                self.max_batch = max(self.max_batch, len(jobs))
+                self.commit_time += duration
+        for index, job in enumerate(jobs):
+            if exception is not None:
+                job.future.set_exception(exception)
+            else:
+                job.future.set_result(results[index])
+
+    def to_dict(self):
+        with self._lock:
+            successful = self.jobs - self.failed_jobs
+            return {
+                "queue_depth": self._queue.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                "jobs": self.jobs,
+                "failed_jobs": self.failed_jobs,
+                "commits": self.commits,
+                "avg_batch_size": float(successful) / self.commits if self.commits else 0.0,
+                "max_batch_size": self.max_batch,
+                "last_batch_size": self.last_batch,
+                "retried_batches": self.retried_batches,
+                "commit_time": self.commit_time,
+            }
+
+
+class SerializedWriteException(Exception):
+    pass
@@ -1,3 +1,4 @@
+from click import Argument
 from groundwork.patterns import GwCommandsPattern
 
 
@@ -8,9 +9,79 @@ class GwDatabasePlugin(GwCommandsPattern):
 
     def activate(self):
         self.commands.register("database_list", "List all databases", self._list_db)
+        self.commands.register("database_stats", "Show usage statistics of all databases", self._stats_db,
+                               params=[Argument(("database",), required=False)])
 
     def _list_db(self):
         print("Registered databases")
         databases = self.app.databases.get()
         for key, db in databases.items():
             print("  %s\n  %s\n  %s\n" % (db.name, db.description, db.database_url))
+
+    def _stats_db(self, database=None):
+        print("Database statistics")
+        for name, stats in self.app.databases.stats(database).items():
+            print("  %s\n  %s\n  %s" % (name, stats["description"], stats["url"]))
+            if stats["size"] is not None:
+                print("    Size:       %s" % _format_size(stats["size"]))
+            print("    Classes:    %s" % stats["classes"])
+
+            if not stats["built"]:
+                print("    Engine not created yet (lazy)\n")
+                continue
+
+            pool = stats["pool"]
+            print("    Pool:       %s, checked out %s, overflow %s, timeouts %s, wait time %s"
+                  % (pool["pool_class"], pool["checked_out"], pool["overflow"] or 0, pool["timeouts"],
+                     _format_time(pool["wait_time"])))
+
+            writer = stats.get("writer")
+            if writer is not None:
+                print("    Writer:     queue %s (max %s), %s jobs in %s commits, avg batch %.1f, max batch %s"
+                      % (writer["queue_depth"], writer["max_queue_depth"], writer["jobs"], writer["commits"],
+                         writer["avg_batch_size"], writer["max_batch_size"]))
+
+            write_buffer = stats.get("write_buffer")
+            if write_buffer is not None and write_buffer["added"]:
+                print("    Buffer:     %s buffered, %s flushed in %s flushes, %s failed, blocked %s times"
+                      % (write_buffer["buffered"], write_buffer["flushed"], write_buffer["flushes"],
+                         write_buffer["failed"], write_buffer["blocked"]))
+
+            change_feed = stats.get("change_feed")
+            if change_feed is not None:
+                print("    Changes:    %s change sets, %s subscriptions, %s dropped"
+                      % (change_feed["change_sets"], change_feed["subscriptions"], change_feed["dropped"]))
+
+            statements = stats["statements"]
+            if statements is None:
+                print("    Statements: not instrumented")
+            else:
+                print("    Statements: %s, p50 %s, p95 %s, p99 %s"
+                      % (statements["count"], _format_time(statements["p50"]), _format_time(statements["p95"]),
+                         _format_time(statements["p99"])))
+                for statement in stats["slowest_statements"]:
+                    print("      %s  %s" % (_format_time(statement["max_time"]), statement["statement"][:100]))
+
+            for shard, tables in stats.get("shards", {}).items():
+                rows = ", ".join("%s: %s" % (table, table_rows) for table, table_rows in sorted(tables.items()))
+                print("    Shard:      %s, %s" % (shard, rows))
+
+            print("    Tables:")
+            for table, table_stats in sorted(stats["tables"].items()):
+                estimated = " (estimated)" if table_stats["estimated"] else ""
+                print("      %s: %s%s" % (table, table_stats["rows"], estimated))
+            print("")
+
+
+def _format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024.0
+    return "%.1f TB" % size
+
+
+def _format_time(seconds):
+    if seconds < 1:
+        return "%.1fms" % (seconds * 1000)
+    return "%.2fs" % seconds
@@ -25,7 +25,8 @@ setup(
     packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
     include_package_data=True,
     platforms='any',
-    install_requires=['groundwork>=0.1.14', 'sqlalchemy', 'docstring_parser'],
+    install_requires=['groundwork>=0.1.14', 'sqlalchemy>=1.4', 'docstring_parser'],
+    extras_require={'numpy': ['numpy']},
     tests_require=['pytest', 'pytest-flake8'],
     classifiers=[
         'Development Status :: 4 - Beta',
@@ -37,12 +38,12 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
     entry_points={
         'groundwork.plugin': ["groundwork_database = "
@@ -1,4 +1,5 @@
 from click.testing import CliRunner
+from sqlalchemy import Column, Integer, String, text
 from groundwork_database.plugins import GwDatabasePlugin
 
 
@@ -16,3 +17,42 @@ def test_plugin_list(basicApp):
 
     runner = CliRunner()
     runner.invoke(basicApp.commands.get("database_list").click_command)
+
+
+def test_plugin_stats(basicApp, DatabasePlugin, tmpdir):
+    plugin = GwDatabasePlugin(basicApp)
+    plugin.activate()
+    basicApp.plugins.classes.register([DatabasePlugin])
+    basicApp.plugins.activate(["DatabasePlugin"])
+    db_plugin = basicApp.plugins.get("DatabasePlugin")
+
+    db = db_plugin.databases.register("stats_db", "sqlite:///%s" % tmpdir.join("stats.db"), "stats database",
+                                      instrument=True)
+    db_plugin.databases.register("lazy_db", "sqlite:///:memory:", "lazy database", lazy=True)
+
+    class Item(db.Base):
+        __tablename__ = "items"
+        id = Column(Integer, primary_key=True)
+        name = Column(String)
+
+    db.classes.register(Item)
+    db.create_all()
+    db.bulk_insert(Item, [{"id": i, "name": "item"} for i in range(10)])
+
+    stats = basicApp.databases.stats("stats_db")["stats_db"]
+    assert stats["classes"] == 1
+    assert stats["tables"]["items"] == {"rows": 10, "estimated": False}
+    assert stats["size"] > 0
+    assert stats["statements"]["count"] > 0
+    assert stats["pool"]["pool_class"] == "QueuePool"
+
+    with db.engine.begin() as connection:
+        connection.execute(text("ANALYZE"))
+    assert db.stats()["tables"]["items"] == {"rows": 10, "estimated": True}
+
+    runner = CliRunner()
+    result = runner.invoke(basicApp.commands.get("database_stats").click_command)
+    assert result.exit_code == 0
+    assert "stats_db" in result.output
+    assert "items: 10 (estimated)" in result.output
+    assert "Engine not created yet" in result.output